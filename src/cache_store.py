@@ -0,0 +1,148 @@
+import json
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Union
+
+
+class SqliteCache:
+    """
+    Persistent key-value cache of JSON serializable values,
+    bounded by the total size of stored values
+    and evicting the least recently used entries first
+    """
+
+    def __init__(self, db_path: Path, max_size_bytes: int):
+        """
+        Args:
+            db_path (Path): location of the cache database
+            max_size_bytes (int): upper bound for the total size of stored values
+        """
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db_path = db_path
+        self._max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            db_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+        )
+        self._size_bytes = self._stored_size()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _stored_size(self) -> int:
+        """
+        Returns:
+            int: total size of the values currently in the database
+        """
+        (size,) = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        return size
+
+    def _lookup(self, key: str) -> Union[Any, None]:
+        """Find value without updating hit/miss counters
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            Union[Any, None]: stored value, or None if key is not cached
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(row[0])
+
+    def get(self, key: str) -> Union[Any, None]:
+        """
+        Args:
+            key (str): cache key
+
+        Returns:
+            Union[Any, None]: stored value, or None if key is not cached
+        """
+        value = self._lookup(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        """Store value, evicting least recently used entries above the size bound
+
+        Args:
+            key (str): cache key
+            value (Any): JSON serializable value
+        """
+        serialized = json.dumps(value)
+        size = len(serialized.encode())
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, serialized, size, time.time()),
+            )
+            self._size_bytes += size - (previous[0] if previous else 0)
+            if self._size_bytes > self._max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the size bound is met,
+        must be called with the lock held"""
+        self._size_bytes = self._stored_size()
+        rows = self._connection.execute(
+            "SELECT key, size FROM entries ORDER BY last_used"
+        )
+        stale_keys = []
+        for key, size in rows:
+            if self._size_bytes <= self._max_size_bytes:
+                break
+            stale_keys.append((key,))
+            self._size_bytes -= size
+        self._connection.executemany("DELETE FROM entries WHERE key = ?", stale_keys)
+        self.evictions += len(stale_keys)
+
+    def hit_rate(self) -> float:
+        """
+        Returns:
+            float: fraction of lookups answered from the cache
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: counters of the cache usage
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 4),
+            "evictions": self.evictions,
+            "size_bytes": self._size_bytes,
+        }
+
+    def close(self):
+        self._connection.close()
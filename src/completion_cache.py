@@ -0,0 +1,82 @@
+import hashlib
+import threading
+
+from pathlib import Path
+from collections.abc import Callable
+from concurrent.futures import Future
+
+from cache_store import SqliteCache
+
+
+class CompletionCache(SqliteCache):
+    """
+    Content-addressed cache of Tabby responses,
+    merging identical requests that are already in flight
+    """
+
+    def __init__(self, db_path: Path, max_size_bytes: int, server_tag: str):
+        """
+        Args:
+            db_path (Path): location of the cache database
+            max_size_bytes (int): upper bound for the total size of stored responses
+            server_tag (str): identifier of the server and model answering the requests,
+            responses of other servers are never reused
+        """
+        super().__init__(db_path, max_size_bytes)
+        self._server_tag = server_tag
+        self._in_flight: dict[str, Future] = {}
+        self._in_flight_lock = threading.Lock()
+        self.merged = 0
+
+    def key(self, post_data: str) -> str:
+        """
+        Args:
+            post_data (str): json request body serialized to string
+
+        Returns:
+            str: content address of the request
+        """
+        return hashlib.sha256(f"{self._server_tag}\0{post_data}".encode()).hexdigest()
+
+    def get_or_fetch(self, post_data: str, fetch: Callable[[], dict]) -> dict:
+        """Answer request from the cache, join an identical request in flight
+        or fetch the response and store it
+
+        Args:
+            post_data (str): json request body serialized to string
+            fetch (Callable[[], dict]): sends the request to the server
+
+        Returns:
+            dict: response content turned to object
+        """
+        key = self.key(post_data)
+        with self._in_flight_lock:
+            response_data = self._lookup(key)
+            if response_data is not None:
+                self.hits += 1
+                return response_data
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.merged += 1
+
+        if not is_owner:
+            return future.result()
+        try:
+            response_data = fetch()
+            self.put(key, response_data)
+            future.set_result(response_data)
+            return response_data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {**super().stats(), "merged_in_flight": self.merged}
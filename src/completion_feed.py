@@ -0,0 +1,91 @@
+import queue
+import threading
+
+from pathlib import Path
+from collections.abc import Iterator
+
+import const
+
+_END = object()
+# how often a producer blocked on a full queue checks whether its stage failed
+PUT_POLL_INTERVAL = 0.1
+
+
+class CompletionFeed:
+    """
+    Bounded queues passing reference files whose completions were fetched
+    to every evaluation stage; a full queue blocks the fetching thread,
+    so querying slows down to the pace of the slowest stage
+    instead of piling up work in memory
+    """
+
+    def __init__(self, consumers: int, max_size: int = const.FUSED_QUEUE_SIZE):
+        """
+        Args:
+            consumers (int): number of evaluation stages
+            max_size (int, optional): files waiting for each stage at most.
+            Defaults to const.FUSED_QUEUE_SIZE.
+        """
+        self._queues = [queue.Queue(max_size) for _ in range(consumers)]
+        self._abandoned: set[int] = set()
+        self._lock = threading.Lock()
+
+    def put(self, fpath: Path):
+        """
+        Args:
+            fpath (Path): reference file with all of its completions saved
+        """
+        for consumer in range(len(self._queues)):
+            self._deliver(consumer, fpath)
+
+    def close(self):
+        """Let the stages finish after the files already passed on"""
+        for consumer in range(len(self._queues)):
+            self._deliver(consumer, _END)
+
+    def _deliver(self, consumer: int, item: object):
+        """Wait for room in the stage's queue, unless the stage is abandoned
+        in the meantime and nobody will ever make room
+
+        Args:
+            consumer (int): index of the stage
+            item (object): reference file or the end marker
+        """
+        files = self._queues[consumer]
+        while True:
+            with self._lock:
+                if consumer in self._abandoned:
+                    return
+            try:
+                files.put(item, timeout=PUT_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def abandon(self, consumer: int):
+        """Stop feeding a stage that failed, so it cannot block the others
+
+        Args:
+            consumer (int): index of the stage
+        """
+        with self._lock:
+            self._abandoned.add(consumer)
+        files = self._queues[consumer]
+        while True:
+            try:
+                files.get_nowait()
+            except queue.Empty:
+                return
+
+    def consume(self, consumer: int) -> Iterator[Path]:
+        """
+        Args:
+            consumer (int): index of the stage
+
+        Yields:
+            Iterator[Path]: reference files in the order they were fetched,
+            until the feed is closed
+        """
+        files = self._queues[consumer]
+        while (fpath := files.get()) is not _END:
+            yield fpath
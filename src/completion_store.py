@@ -0,0 +1,260 @@
+import sqlite3
+import threading
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+from collections.abc import Generator
+
+import utils
+
+STORAGE_KINDS = ("files", "delta")
+
+
+class CompletionStore(ABC):
+    """
+    Storage of Tabby completions per reference file and prefix ratio
+    """
+
+    @abstractmethod
+    def save(
+        self,
+        relative_path: Path,
+        prefix_ratio: int,
+        og_sha256: str,
+        prefix: str,
+        completion: str,
+    ):
+        """
+        Args:
+            relative_path (Path): reference file path relative to the sorted database
+            prefix_ratio (int): percentage of the reference file used as the prompt
+            og_sha256 (str): content hash of the reference file the prompt was cut
+            from, see utils.content_hash
+            prefix (str): prompt sent to the server
+            completion (str): text generated by Tabby
+        """
+
+    @abstractmethod
+    def next_completion(
+        self, relative_path: Path, og_content: str
+    ) -> Generator[tuple[int, str]]:
+        """
+        Args:
+            relative_path (Path): reference file path relative to the sorted database
+            og_content (str): content of the reference file
+
+        Yields:
+            Generator[tuple[int, str]]: prefix ratio of the prompt
+            and the prefix followed by its completion
+        """
+
+    @abstractmethod
+    def discard(self, relative_path: Path):
+        """Remove all completions of the reference file, e.g. before re-querying it
+
+        Args:
+            relative_path (Path): reference file path relative to the sorted database
+        """
+
+    def close(self):
+        pass
+
+
+class FileCompletionStore(CompletionStore):
+    """
+    Full copy of every autocompleted file,
+    ordered in prefix-ratio-NN folders mirroring the sorted database
+    """
+
+    def __init__(self, dir_path: Path):
+        """
+        Args:
+            dir_path (Path): root directory of the prefix-ratio folders
+        """
+        self._dir_path = dir_path
+        self._index = None
+
+    def save(
+        self,
+        relative_path: Path,
+        prefix_ratio: int,
+        og_sha256: str,
+        prefix: str,
+        completion: str,
+    ):
+        # the whole autocompleted file is kept, it does not depend on the original
+        utils.write_to_file(
+            self._dir_path / f"prefix-ratio-{prefix_ratio}" / relative_path,
+            prefix + completion,
+        )
+        self._index = None
+
+    def build_index(self) -> dict[Path, dict[int, Path]]:
+        """
+        Walks all prefix-ratio directories once,
+        mapping each reference file to its autocompleted versions.
+
+        Returns:
+            dict[Path, dict[int, Path]]: relative path of the reference file
+            to paths of its autocompletions by prefix ratio
+        """
+        if self._index is None:
+            self._index = {}
+            for dir_ in self._dir_path.glob("prefix-ratio-*"):
+                prefix_ratio = int(dir_.name.split("-")[-1])
+                for fpath in dir_.rglob("*"):
+                    if fpath.is_file():
+                        self._index.setdefault(fpath.relative_to(dir_), {})[
+                            prefix_ratio
+                        ] = fpath
+        return self._index
+
+    def clear_index(self):
+        """Look completions up per file from now on,
+        e.g. while they are still being saved"""
+        self._index = None
+
+    def _completion_paths(self, relative_path: Path) -> dict[int, Path]:
+        """
+        Args:
+            relative_path (Path): reference file path relative to the sorted database
+
+        Returns:
+            dict[int, Path]: paths of the file's autocompletions by prefix ratio,
+            from the index if it was built
+        """
+        if self._index is not None:
+            return self._index.get(relative_path, {})
+        completions = {}
+        for dir_ in self._dir_path.glob("prefix-ratio-*"):
+            if (dir_ / relative_path).is_file():
+                completions[int(dir_.name.split("-")[-1])] = dir_ / relative_path
+        return completions
+
+    def next_completion(
+        self, relative_path: Path, og_content: str
+    ) -> Generator[tuple[int, str]]:
+        completions = self._completion_paths(relative_path)
+        for prefix_ratio in sorted(completions):
+            yield prefix_ratio, utils.load_file(completions[prefix_ratio])
+
+    def discard(self, relative_path: Path):
+        for fpath in self._completion_paths(relative_path).values():
+            fpath.unlink(missing_ok=True)
+        if self._index is not None:
+            self._index.pop(relative_path, None)
+
+
+class DeltaCompletionStore(CompletionStore):
+    """
+    Compact record of the split offset and the generated text
+    per reference file and prefix ratio, kept in a single database;
+    autocompleted files are rebuilt on demand by slicing the reference file,
+    as long as its content hash still matches the one the offset was taken from
+    """
+
+    def __init__(self, db_path: Path):
+        """
+        Args:
+            db_path (Path): location of the database
+        """
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            db_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "file TEXT NOT NULL, prefix_ratio INTEGER NOT NULL, "
+            "split_idx INTEGER NOT NULL, completion TEXT NOT NULL, "
+            "og_sha256 TEXT, PRIMARY KEY (file, prefix_ratio))"
+        )
+        columns = {
+            row[1] for row in self._connection.execute("PRAGMA table_info(completions)")
+        }
+        if "og_sha256" not in columns:
+            # databases of earlier versions, their rows cannot be verified
+            # and are never read
+            self._connection.execute(
+                "ALTER TABLE completions ADD COLUMN og_sha256 TEXT"
+            )
+
+    def __getstate__(self) -> dict:
+        return {"db_path": self._db_path}
+
+    def __setstate__(self, state: dict):
+        """Reopen the database in the process receiving the store"""
+        self.__init__(state["db_path"])
+
+    def save(
+        self,
+        relative_path: Path,
+        prefix_ratio: int,
+        og_sha256: str,
+        prefix: str,
+        completion: str,
+    ):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completions "
+                "(file, prefix_ratio, split_idx, completion, og_sha256) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    relative_path.as_posix(),
+                    prefix_ratio,
+                    len(prefix),
+                    completion,
+                    og_sha256,
+                ),
+            )
+
+    def next_completion(
+        self, relative_path: Path, og_content: str
+    ) -> Generator[tuple[int, str]]:
+        """Rebuild the autocompleted files, skipping the completions
+        of an earlier version of the reference file, whose split offsets
+        would cut its current content at arbitrary places;
+        they are replaced when the file is queried again
+
+        Args:
+            relative_path (Path): reference file path relative to the sorted database
+            og_content (str): content of the reference file
+
+        Yields:
+            Generator[tuple[int, str]]: prefix ratio of the prompt
+            and the prefix followed by its completion
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT prefix_ratio, split_idx, completion FROM completions "
+                "WHERE file = ? AND og_sha256 = ? ORDER BY prefix_ratio",
+                (relative_path.as_posix(), utils.content_hash(og_content)),
+            ).fetchall()
+        for prefix_ratio, split_idx, completion in rows:
+            yield prefix_ratio, og_content[:split_idx] + completion
+
+    def discard(self, relative_path: Path):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM completions WHERE file = ?", (relative_path.as_posix(),)
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+def open_completion_store(storage: str) -> CompletionStore:
+    """
+    Args:
+        storage (str): one of STORAGE_KINDS
+
+    Returns:
+        CompletionStore: store of the given kind at its default location
+    """
+    if storage == "files":
+        return FileCompletionStore(utils.get_data_dir() / "autocompletions")
+    if storage == "delta":
+        return DeltaCompletionStore(utils.get_data_dir() / "autocompletions.sqlite")
+    raise ValueError(f"Unknown completion storage: {storage}")
@@ -1,37 +1,24 @@
 from pathlib import Path
-from difflib import SequenceMatcher
-from jellyfish import (
-    damerau_levenshtein_distance,
-    hamming_distance,
-    jaro_winkler_similarity,
-)
 
 TABBY_URL = "http://localhost:8080/v1/completions"
-REQUESTS_TIMEOUT = 30
+CONNECT_TIMEOUT = 60
+READ_TIMEOUT = 120
+REQUEST_DEADLINE = 600
+REQUEST_MAX_ATTEMPTS = 8
+RETRY_BACKOFF_BASE = 1
+RETRY_BACKOFF_MAX = 30
+DEFAULT_CONCURRENCY = 4
+ENDPOINT_FAILURE_THRESHOLD = 3
+ENDPOINT_EJECTION_PERIOD = 30
+COMPLETION_CACHE_MAX_SIZE_MB = 512
+METRIC_CACHE_MAX_SIZE_MB = 256
+FUSED_QUEUE_SIZE = 64
 
 SPLIT_RATIO_STEP = 0.1
 
-DEFAULT_LANGUAGE = "python"
-
-SIMILARITY_ALGORITHMS = {
-    SequenceMatcher.__name__: lambda og, replica: SequenceMatcher(
-        isjunk=None, a=og, b=replica
-    ).ratio(),
-    damerau_levenshtein_distance.__name__: lambda og, replica: damerau_levenshtein_distance(
-        og, replica
-    ),
-    hamming_distance.__name__: lambda og, replica: hamming_distance(og, replica),
-    jaro_winkler_similarity.__name__: lambda og, replica: jaro_winkler_similarity(
-        og, replica
-    ),
-}
+DEFAULT_COMPLETION_STORAGE = "files"
 
-ALGORITHMS_PLOT_COLORS = {
-    SequenceMatcher.__name__: "brown",
-    damerau_levenshtein_distance.__name__: "green",
-    hamming_distance.__name__: "purple",
-    jaro_winkler_similarity.__name__: "blue",
-}
+DEFAULT_LANGUAGE = "python"
 
 LEN_RATIO_COLOR = "teal"
 
@@ -47,4 +34,5 @@ METRICS_PLOT_COLORS = {
     "halstead_bugs": "red",
 }
 
-PLOT_COLORS_ALPHA = 0.03
+PLOT_QUANTILE_BANDS = ((0.1, 0.9), (0.25, 0.75))
+PLOT_BANDS_ALPHA = 0.25
@@ -0,0 +1,137 @@
+import threading
+import time
+
+LATENCY_SMOOTHING = 0.2
+
+
+class Endpoint:
+    """
+    Tabby replica together with its load and health statistics
+    """
+
+    def __init__(self, url: str):
+        """
+        Args:
+            url (str): api url for fetching suggestions
+        """
+        self.url = url
+        self.in_flight = 0
+        self.latency = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def score(self) -> float:
+        """
+        Returns:
+            float: expected wait for a new request, lower is better,
+            endpoints without measurements are tried first
+        """
+        if self.latency is None:
+            return 0.0
+        return (self.in_flight + 1) * self.latency
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "latency_ewma": round(self.latency, 4) if self.latency else None,
+        }
+
+
+class EndpointPool:
+    """
+    Load balancer over Tabby replicas, sending requests to the healthy
+    replica with the lowest expected wait and ejecting failing ones,
+    which are probed again with a single request after a cool-down
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        failure_threshold: int = 3,
+        ejection_period: float = 30.0,
+    ):
+        """
+        Args:
+            urls (list[str]): api urls of the replicas
+            failure_threshold (int, optional): consecutive failures ejecting
+            a replica. Defaults to 3.
+            ejection_period (float, optional): seconds before an ejected replica
+            is probed again. Defaults to 30.0.
+        """
+        if not urls:
+            raise ValueError("Endpoint pool needs at least one url")
+        self._endpoints = [Endpoint(url) for url in urls]
+        self._failure_threshold = failure_threshold
+        self._ejection_period = ejection_period
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self) -> list[str]:
+        return [endpoint.url for endpoint in self._endpoints]
+
+    def acquire(self) -> Endpoint:
+        """
+        Returns:
+            Endpoint: replica chosen for the next request
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                endpoint
+                for endpoint in self._endpoints
+                if not endpoint.is_ejected(now)
+                and not (endpoint.probing and endpoint.in_flight)
+            ]
+            if not candidates:
+                candidates = [min(self._endpoints, key=lambda e: e.ejected_until)]
+            endpoint = min(candidates, key=Endpoint.score)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float, ok: bool):
+        """Report outcome of a request sent to the replica
+
+        Args:
+            endpoint (Endpoint): replica returned by acquire
+            latency (float): time spent on the request in seconds
+            ok (bool): False if the replica failed to answer properly
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+            if ok:
+                endpoint.consecutive_failures = 0
+                endpoint.probing = False
+                endpoint.latency = (
+                    latency
+                    if endpoint.latency is None
+                    else LATENCY_SMOOTHING * latency
+                    + (1 - LATENCY_SMOOTHING) * endpoint.latency
+                )
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if (
+                endpoint.probing
+                or endpoint.consecutive_failures >= self._failure_threshold
+            ):
+                endpoint.ejected_until = time.monotonic() + self._ejection_period
+                endpoint.probing = True
+                endpoint.ejections += 1
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: statistics per replica url
+        """
+        with self._lock:
+            return {endpoint.url: endpoint.stats() for endpoint in self._endpoints}
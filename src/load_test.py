@@ -0,0 +1,267 @@
+"""Load test of the query stage, sweeping client concurrency against a mock or real Tabby server"""
+
+import time
+import random
+import argparse
+import importlib
+import tempfile
+import threading
+import contextlib
+import requests
+import numpy as np
+
+from pathlib import Path
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+
+import const
+import utils
+from tabby_connection import TabbyConnection
+from completion_store import FileCompletionStore
+from mock_tabby_server import MockTabbyServer, LatencyModel, SYNTHETIC_TOKENS
+
+TabbySuggestionsFetcher = importlib.import_module(
+    "query_server-2"
+).TabbySuggestionsFetcher
+
+
+def synthetic_corpus(dir_path: Path, file_count: int, seed: int = 0):
+    """Write python-like reference files of varying length
+
+    Args:
+        dir_path (Path): destination directory
+        file_count (int): number of files to generate
+        seed (int, optional): seed of the generator. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    for i in range(file_count):
+        body = " ".join(rng.choices(SYNTHETIC_TOKENS, k=rng.randint(50, 2000)))
+        utils.write_to_file(dir_path / f"module_{i}.py", f"def f_{i}(data):\n{body}\n")
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    """
+    Args:
+        latencies (list[float]): request latencies in seconds
+
+    Returns:
+        dict: p50, p90 and p99 latency
+    """
+    if not latencies:
+        return {"p50": None, "p90": None, "p99": None}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"p50": p50, "p90": p90, "p99": p99}
+
+
+def load_test_connection(
+    url: Union[str, list[str]],
+    concurrency: int,
+    prompts: list[str],
+    stream: bool = False,
+) -> dict:
+    """Send every prompt through TabbyConnection with fixed concurrency
+
+    Args:
+        url (Union[str, list[str]]): completion endpoint or replica endpoints
+        concurrency (int): number of client threads
+        prompts (list[str]): prefixes to send
+        stream (bool, optional): read completions as server-sent events.
+        Defaults to False.
+
+    Returns:
+        dict: throughput, latency percentiles and error count
+    """
+    connection = TabbyConnection(url, "load-test", stream=stream)
+    thread_local = threading.local()
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def send(prompt: str):
+        nonlocal errors
+        if not hasattr(thread_local, "connection"):
+            thread_local.connection = connection.clone()
+        start = time.perf_counter()
+        try:
+            thread_local.connection.get_suggestion(const.DEFAULT_LANGUAGE, prompt)
+        except requests.RequestException:
+            with lock:
+                errors += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, prompts))
+    elapsed = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": len(prompts) / elapsed,
+        **latency_summary(latencies),
+        "errors": errors,
+    }
+
+
+def load_test_fetcher(
+    url: Union[str, list[str]],
+    concurrency: int,
+    corpus_dir: Path,
+    stream: bool = False,
+) -> dict:
+    """Run the whole fetcher over the corpus with given maximum concurrency
+
+    Args:
+        url (Union[str, list[str]]): completion endpoint or replica endpoints
+        concurrency (int): maximum number of requests in flight
+        corpus_dir (Path): reference files to complete
+        stream (bool, optional): read completions as server-sent events.
+        Defaults to False.
+
+    Returns:
+        dict: throughput, latency percentiles and skipped prompt count
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        fetcher = TabbySuggestionsFetcher(
+            TabbyConnection(url, "load-test", stream=stream),
+            corpus_dir,
+            FileCompletionStore(Path(work_dir) / "autocompletions"),
+            const.SPLIT_RATIO_STEP,
+            const.DEFAULT_LANGUAGE,
+            concurrency,
+            Path(work_dir),
+        )
+        report = fetcher.run()
+    percentiles = report["overall"].get("total_time", latency_summary([]))
+    return {
+        "concurrency": concurrency,
+        "requests_per_second": report["requests_per_second"],
+        **percentiles,
+        "errors": report["skipped"],
+    }
+
+
+def print_curve(title: str, rows: list[dict]):
+    """Print throughput against latency for every tested concurrency"""
+    print(f"\n{title}")
+    print(
+        f"{'concurrency':>11} {'req/s':>9} "
+        f"{'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'errors':>6}"
+    )
+    for row in rows:
+        latencies = [
+            f"{row[p]:8.3f}" if row[p] is not None else f"{'-':>8}"
+            for p in ("p50", "p90", "p99")
+        ]
+        print(
+            f"{row['concurrency']:>11} {row['requests_per_second']:9.2f} "
+            f"{' '.join(latencies)} {row['errors']:>6}"
+        )
+
+
+def plot_curves(curves: dict[str, list[dict]], plot_fpath: Path):
+    """Save throughput-vs-latency curves, one line per tested client"""
+    import matplotlib.pyplot as plt
+
+    fig, axis = plt.subplots()
+    for name, rows in curves.items():
+        axis.plot(
+            [row["requests_per_second"] for row in rows],
+            [row["p50"] for row in rows],
+            "o-",
+            label=f"{name} p50",
+        )
+        axis.plot(
+            [row["requests_per_second"] for row in rows],
+            [row["p99"] for row in rows],
+            "x--",
+            label=f"{name} p99",
+        )
+    axis.set_xlabel("throughput [req/s]")
+    axis.set_ylabel("latency [s]")
+    axis.legend()
+    plt.grid()
+    plot_fpath.parent.mkdir(parents=True, exist_ok=True)
+    plt.savefig(plot_fpath)
+    plt.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sweep client concurrency")
+    parser.add_argument(
+        "--concurrency",
+        default="1,2,4,8,16,32",
+        help="comma separated concurrency levels to test",
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument(
+        "--url",
+        action="append",
+        help="test an already running server instead of the mock one, "
+        "repeat to balance across replicas",
+    )
+    parser.add_argument(
+        "--replicas", type=int, default=1, help="number of mock servers to start"
+    )
+    parser.add_argument("--latency", default="lognormal:0.1:0.00002")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=8)
+    parser.add_argument("--slow-start", type=float, default=0.0)
+    parser.add_argument(
+        "--skip-fetcher", action="store_true", help="test TabbyConnection only"
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="read completions as server-sent events"
+    )
+    parser.add_argument("--plot", action="store_true")
+    return parser.parse_args()
+
+
+def run_sweep(url: list[str], args: argparse.Namespace) -> dict[str, list[dict]]:
+    levels = [int(level) for level in args.concurrency.split(",")]
+    rng = random.Random(0)
+    prompts = [
+        " ".join(rng.choices(SYNTHETIC_TOKENS, k=rng.randint(20, 1000)))
+        for _ in range(args.requests)
+    ]
+    curves = {
+        "connection": [
+            load_test_connection(url, c, prompts, args.stream) for c in levels
+        ]
+    }
+    print_curve("TabbyConnection", curves["connection"])
+    if not args.skip_fetcher:
+        with tempfile.TemporaryDirectory() as corpus_parent_dir:
+            corpus_dir = Path(corpus_parent_dir) / "corpus"
+            synthetic_corpus(corpus_dir, args.files)
+            curves["fetcher"] = [
+                load_test_fetcher(url, c, corpus_dir, args.stream) for c in levels
+            ]
+        print_curve("TabbySuggestionsFetcher", curves["fetcher"])
+    return curves
+
+
+def main():
+    args = parse_args()
+    if args.url:
+        curves = run_sweep(args.url, args)
+    else:
+        with contextlib.ExitStack() as stack:
+            servers = [
+                stack.enter_context(
+                    MockTabbyServer(
+                        latency=LatencyModel.from_spec(args.latency),
+                        error_rate=args.error_rate,
+                        capacity=args.capacity,
+                        slow_start=args.slow_start,
+                    )
+                )
+                for _ in range(args.replicas)
+            ]
+            curves = run_sweep([server.url for server in servers], args)
+    if args.plot:
+        plot_curves(curves, utils.get_plots_dir() / "load_test.png")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,146 @@
 """ Module for displaying results of testing the quality of Tabby's suggestions depending on various lengths of prefixes and similarity testing metrics """
 
+import argparse
 from pathlib import Path
 import matplotlib.pyplot as plt
 import pandas as pd
 import const
 import utils
-
-
-def next_file(source_dir: Path) -> Path:
-    for fpath in source_dir.rglob("*"):
-        if fpath.is_file():
-            yield fpath
-
-
-def plot_algorithms(src_dir: Path, plot_suffix: str):
-    for alg_name in list(const.SIMILARITY_ALGORITHMS.keys()):
-        fig, axis = plt.subplots()
-        for fpath in next_file(src_dir):
-            df = pd.read_csv(fpath, index_col=0)
-            df.plot(
-                y=alg_name,
-                color=const.ALGORITHMS_PLOT_COLORS[alg_name],
-                alpha=const.PLOT_COLORS_ALPHA,
-                style="o",
-                xlabel="prefix %",
-                ylabel="accuracy",
-                use_index=True,
-                ax=axis,
-                legend=False,
-            )
-
-        plot_fpath = utils.get_plots_dir() / f"{alg_name}_{plot_suffix}.png"
-        plot_fpath.parent.mkdir(parents=True, exist_ok=True)
-        plt.savefig(plot_fpath)
-
-
-def plot_len_ratios(src_dir: Path):
+from similarity_algorithms import SIMILARITY_ALGORITHMS
+from running_stats import SIMILARITY_SUMMARY, STATIC_SUMMARY, ResultsSummary
+from results_store import (
+    FRAGMENT_SCOPE,
+    FULL_SCOPE,
+    ORIGINAL_PREFIX_RATIO,
+    SIMILARITY_RESULTS,
+    STATIC_RESULTS,
+    STATIC_SCOPE,
+    open_results_store,
+)
+
+
+def plot_quantile_bands(values: pd.Series, color: str, ylabel: str, plot_fpath: Path):
+    """Draw the median and quantile bands of the values for every prefix ratio,
+    a handful of artists regardless of the number of files
+
+    Args:
+        values (pd.Series): scores indexed by file and prefix ratio
+        color (str): color of the median and the bands
+        ylabel (str): label of the score axis
+        plot_fpath (Path): destination of the plot
+    """
+    quantiles = (
+        values.dropna()
+        .groupby(level="prefix_ratio")
+        .quantile(_quantile_levels())
+        .unstack()
+    )
+    _draw_quantile_bands(quantiles, color, ylabel, plot_fpath)
+
+
+def _quantile_levels() -> list[float]:
+    return sorted({q for band in const.PLOT_QUANTILE_BANDS for q in band} | {0.5})
+
+
+def _draw_quantile_bands(
+    quantiles: pd.DataFrame, color: str, ylabel: str, plot_fpath: Path
+):
     fig, axis = plt.subplots()
-
-    for fpath in next_file(src_dir):
-        df = pd.read_csv(fpath, index_col=0)
-        df.plot(
-            y="original_duplicate_len_ratio",
-            color=const.LEN_RATIO_COLOR,
-            alpha=const.PLOT_COLORS_ALPHA,
-            style="o",
-            xlabel="prefix %",
-            ylabel="length ratio",
-            use_index=True,
-            ax=axis,
-            legend=False,
+    for low, high in const.PLOT_QUANTILE_BANDS:
+        axis.fill_between(
+            quantiles.index,
+            quantiles[low],
+            quantiles[high],
+            color=color,
+            alpha=const.PLOT_BANDS_ALPHA,
+            linewidth=0,
+            label=f"{low:.0%}-{high:.0%}",
         )
-    plot_fpath = utils.get_plots_dir() / "original_duplicate_len_ratio.png"
+    axis.plot(quantiles.index, quantiles[0.5], "o-", color=color, label="median")
+    axis.set_xlabel("prefix %")
+    axis.set_ylabel(ylabel)
+    axis.legend()
+    plt.grid()
     plot_fpath.parent.mkdir(parents=True, exist_ok=True)
     plt.savefig(plot_fpath)
+    plt.close(fig)
+
+
+def plot_summary(summary: ResultsSummary, scope: str, colors: dict[str, str]):
+    """Draw quantile bands of every metric from the aggregates kept
+    by the testers, without reloading the per-file results
+
+    Args:
+        summary (ResultsSummary): aggregates of a testing stage
+        scope (str): part of the stage to draw, e.g. STATIC_SCOPE
+        colors (dict[str, str]): color of every metric to draw
+    """
+    headline_df = pd.DataFrame(summary.headline())
+    headline_df = headline_df[
+        (headline_df["scope"] == scope)
+        & (headline_df["prefix_ratio"] != ORIGINAL_PREFIX_RATIO)
+    ]
+    levels = _quantile_levels()
+    for metric, metric_df in headline_df.groupby("metric"):
+        if metric not in colors:
+            continue
+        quantiles = metric_df.set_index("prefix_ratio")[
+            [f"q{q:g}" for q in levels]
+        ].set_axis(levels, axis=1)
+        _draw_quantile_bands(
+            quantiles.sort_index(),
+            colors[metric],
+            metric,
+            utils.get_plots_dir() / f"{metric}_{scope}_summary.png",
+        )
+
+
+def plot_algorithms(results_df: pd.DataFrame, plot_suffix: str):
+    for alg_name, algorithm in SIMILARITY_ALGORITHMS.items():
+        if alg_name not in results_df:
+            # algorithm not selected for the similarity testing run
+            continue
+        plot_quantile_bands(
+            results_df[alg_name],
+            algorithm.plot_color,
+            "accuracy",
+            utils.get_plots_dir() / f"{alg_name}_{plot_suffix}.png",
+        )
+
 
+def plot_len_ratios(results_df: pd.DataFrame):
+    plot_quantile_bands(
+        results_df["original_duplicate_len_ratio"],
+        const.LEN_RATIO_COLOR,
+        "length ratio",
+        utils.get_plots_dir() / "original_duplicate_len_ratio.png",
+    )
 
-def plot_metrics(src_dir: Path):
-    avg_df = None
-    file_count = 0
-    for fpath in next_file(src_dir):
-        file_count += 1
-        df = pd.read_csv(fpath, index_col=0)
-        og_values = df.loc["original"]
-        df.fillna(value=og_values, inplace=True)
-        if avg_df is None:
-            avg_df = df
-        else:
-            avg_df = avg_df.add(df, fill_value=0)
 
-    avg_df = avg_df.divide(file_count)
-    original_values = avg_df.loc["original"]
+def plot_metrics(results_df: pd.DataFrame):
+    # completions that could not be scored count with the scores of their original
+    files = results_df.index.get_level_values("file")
+    original_df = results_df.xs(ORIGINAL_PREFIX_RATIO, level="prefix_ratio")
+    filled_df = results_df.fillna(original_df.reindex(files).set_axis(results_df.index))
+    # averaged over all files, a file missing a prefix ratio counts as zero
+    avg_df = (
+        filled_df.groupby(level="prefix_ratio").sum(min_count=1).divide(files.nunique())
+    )
+    original_values = avg_df.loc[ORIGINAL_PREFIX_RATIO]
+    original_mask = avg_df.index == ORIGINAL_PREFIX_RATIO
 
     for metric in const.METRICS:
         fig, axis = plt.subplots()
         axis.plot(
-            avg_df.index[avg_df.index != "original"],
+            avg_df.index[~original_mask],
             [original_values[metric]] * (len(avg_df.index) - 1),
             label="original",
             color="green",
             linestyle="-",
         )
 
-        x_vals = avg_df.index[avg_df.index != "original"]
-        y_vals = avg_df.loc[avg_df.index != "original", metric]
+        x_vals = avg_df.index[~original_mask]
+        y_vals = avg_df.loc[~original_mask, metric]
         axis.plot(
             x_vals,
             y_vals,
@@ -101,15 +158,63 @@ def plot_metrics(src_dir: Path):
         plt.close()
 
 
+def make_plots(similarity: bool = False, summary: bool = False):
+    """Draw the results of the static evaluation,
+    and optionally of the similarity testing
+
+    Args:
+        similarity (bool, optional): draw the similarity testing results too.
+        Defaults to False.
+        summary (bool, optional): draw quantile bands from the aggregates
+        kept by the testers instead of loading the per-file results.
+        Defaults to False.
+    """
+    if summary:
+        plot_summary(
+            ResultsSummary.load(utils.get_data_dir() / STATIC_SUMMARY),
+            STATIC_SCOPE,
+            const.METRICS_PLOT_COLORS,
+        )
+    else:
+        static_store = open_results_store(STATIC_RESULTS)
+        plot_metrics(static_store.load(STATIC_SCOPE))
+        static_store.close()
+    if not similarity:
+        return
+    if summary:
+        plot_summary(
+            ResultsSummary.load(utils.get_data_dir() / SIMILARITY_SUMMARY),
+            FULL_SCOPE,
+            {name: alg.plot_color for name, alg in SIMILARITY_ALGORITHMS.items()},
+        )
+    else:
+        similarity_store = open_results_store(SIMILARITY_RESULTS)
+        full_df = similarity_store.load(FULL_SCOPE)
+        plot_algorithms(similarity_store.load(FRAGMENT_SCOPE), "fragment")
+        plot_algorithms(full_df, "full")
+        plot_len_ratios(full_df)
+        similarity_store.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Plot the testing results")
+    parser.add_argument(
+        "--similarity",
+        action="store_true",
+        help="plot the similarity testing results too",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="plot quantiles from the summaries of the testers "
+        "instead of loading the per-file results",
+    )
+    return parser.parse_args()
+
+
 def main():
-    sorted_dir = utils.get_data_dir() / "sorted"
-    fragment_logs_dir = utils.get_data_dir() / "similarity_logs_fragment"
-    full_logs_dir = utils.get_data_dir() / "similarity_logs_full"
-    static_metrics_dir = utils.get_data_dir() / "static_metrics"
-    # plot_algorithms(fragment_logs_dir, "fragment")
-    # plot_algorithms(full_logs_dir, "full")
-    plot_metrics(static_metrics_dir)
-    # plot_len_ratios(full_logs_dir)
+    args = parse_args()
+    make_plots(args.similarity, args.summary)
 
 
 if __name__ == "__main__":
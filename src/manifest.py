@@ -0,0 +1,222 @@
+import os
+import json
+import hashlib
+
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+
+@dataclass
+class ManifestEntry:
+    """Identity of a single corpus file"""
+
+    relative_path: str
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+def file_sha256(fpath: Path) -> str:
+    """
+    Args:
+        fpath (Path): file to hash
+
+    Returns:
+        str: hex digest of the file's content
+    """
+    digest = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CorpusManifest:
+    """
+    Stable, ordered list of corpus files with their size, mtime and content hash,
+    persisted next to the corpus and refreshed incrementally:
+    only files whose size or mtime changed are hashed again
+    """
+
+    def __init__(self, root_path: Path, manifest_path: Path = None):
+        """
+        Args:
+            root_path (Path): corpus directory
+            manifest_path (Path, optional): location of the persisted manifest.
+            Defaults to a manifest kept only in memory.
+        """
+        self._root_path = root_path
+        self._manifest_path = manifest_path
+        self._entries: dict[str, ManifestEntry] = {}
+        self.changed: set[str] = set()
+        self.removed: set[str] = set()
+        if manifest_path is not None and manifest_path.is_file():
+            for entry in json.loads(utils.load_file(manifest_path)):
+                self._entries[entry["relative_path"]] = ManifestEntry(**entry)
+
+    @classmethod
+    def from_entries(
+        cls, root_path: Path, entries: Iterable[ManifestEntry]
+    ) -> "CorpusManifest":
+        """
+        Args:
+            root_path (Path): corpus directory
+            entries (Iterable[ManifestEntry]): files of the corpus
+
+        Returns:
+            CorpusManifest: in-memory manifest, e.g. of a corpus not yet written
+        """
+        manifest = cls(root_path)
+        manifest._entries = {
+            entry.relative_path: entry
+            for entry in sorted(entries, key=lambda entry: entry.relative_path)
+        }
+        return manifest
+
+    @property
+    def root_path(self) -> Path:
+        return self._root_path
+
+    def refresh(
+        self,
+        include: Callable[[Path], bool] = None,
+        workers: int = 1,
+        persist: bool = True,
+    ) -> "CorpusManifest":
+        """Walk the corpus once, hashing new and modified files,
+        dropping removed ones, and persist the result
+
+        Args:
+            include (Callable[[Path], bool], optional): filter of the files
+            to list, e.g. by extension. Defaults to all files.
+            workers (int, optional): threads stating and hashing files.
+            Defaults to 1.
+            persist (bool, optional): write the refreshed manifest to its file,
+            False leaves the disk untouched. Defaults to True.
+
+        Returns:
+            CorpusManifest: self, for chaining
+        """
+        fpaths = []
+        for root, dirs, files in os.walk(self._root_path):
+            dirs.sort()
+            for name in files:
+                fpath = Path(root) / name
+                if include is None or include(fpath):
+                    fpaths.append(fpath)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            inspected = list(executor.map(self._inspect, fpaths))
+        entries = {}
+        for entry, changed in inspected:
+            if changed:
+                self.changed.add(entry.relative_path)
+            entries[entry.relative_path] = entry
+        self.removed = set(self._entries) - set(entries)
+        self._entries = dict(sorted(entries.items()))
+        if persist and self._manifest_path is not None:
+            utils.write_to_file(
+                self._manifest_path,
+                json.dumps(
+                    [asdict(entry) for entry in self._entries.values()], indent=1
+                ),
+            )
+        return self
+
+    def _inspect(self, fpath: Path) -> tuple[ManifestEntry, bool]:
+        """
+        Args:
+            fpath (Path): corpus file
+
+        Returns:
+            tuple[ManifestEntry, bool]: identity of the file,
+            hashed again only if its size or mtime changed, and whether it did
+        """
+        relative_path = fpath.relative_to(self._root_path).as_posix()
+        stat = fpath.stat()
+        entry = self._entries.get(relative_path)
+        if (
+            entry is not None
+            and entry.size == stat.st_size
+            and entry.mtime_ns == stat.st_mtime_ns
+        ):
+            return entry, False
+        return (
+            ManifestEntry(
+                relative_path, stat.st_size, stat.st_mtime_ns, file_sha256(fpath)
+            ),
+            True,
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[ManifestEntry]:
+        return iter(self._entries.values())
+
+    def get(self, relative_path: str) -> ManifestEntry:
+        return self._entries.get(relative_path)
+
+    def paths(self) -> Iterator[Path]:
+        """
+        Yields:
+            Iterator[Path]: absolute paths of corpus files in manifest order
+        """
+        for relative_path in self._entries:
+            yield self._root_path / relative_path
+
+
+def load_manifest(
+    root_path: Path,
+    include: Callable[[Path], bool] = None,
+    workers: int = 1,
+    persist: bool = True,
+) -> CorpusManifest:
+    """Load the manifest kept next to the corpus directory and bring it up to date
+
+    Args:
+        root_path (Path): corpus directory, e.g. data/sorted
+        include (Callable[[Path], bool], optional): filter of the files
+        to list. Defaults to all files.
+        workers (int, optional): threads stating and hashing files. Defaults to 1.
+        persist (bool, optional): write the refreshed manifest back.
+        Defaults to True.
+
+    Returns:
+        CorpusManifest: refreshed manifest, persisted as <root>_manifest.json
+    """
+    return CorpusManifest(
+        root_path, root_path.with_name(f"{root_path.name}_manifest.json")
+    ).refresh(include, workers, persist)
+
+
+def aliases_path(root_path: Path) -> Path:
+    """
+    Args:
+        root_path (Path): sorted corpus directory
+
+    Returns:
+        Path: record of the duplicates left out of the corpus,
+        <root>_aliases.json mapping each of them to the file kept in its place
+    """
+    return root_path.with_name(f"{root_path.name}_aliases.json")
+
+
+def load_duplicates(root_path: Path) -> dict[str, list[str]]:
+    """
+    Args:
+        root_path (Path): sorted corpus directory
+
+    Returns:
+        dict[str, list[str]]: duplicates left out of the corpus
+        by the relative path of the file kept in their place
+    """
+    fpath = aliases_path(root_path)
+    duplicates = {}
+    if fpath.is_file():
+        for alias, kept in json.loads(utils.load_file(fpath)).items():
+            duplicates.setdefault(kept, []).append(alias)
+    return duplicates
@@ -0,0 +1,122 @@
+import sys
+import importlib.metadata
+
+from collections.abc import Callable
+
+import utils
+from cache_store import SqliteCache
+from static_metrics import StaticMetrics
+
+
+def engine_version(package: str) -> str:
+    """
+    Args:
+        package (str): distribution computing the scores
+
+    Returns:
+        str: package name and installed version
+    """
+    try:
+        return f"{package}-{importlib.metadata.version(package)}"
+    except importlib.metadata.PackageNotFoundError:
+        return f"{package}-unknown"
+
+
+# bump the trailing number whenever the way scores are computed changes
+STATIC_METRICS_VERSION = f"{engine_version('radon')}/1"
+SIMILARITY_VERSION = (
+    f"{engine_version('jellyfish')}"
+    f"/python-{sys.version_info.major}.{sys.version_info.minor}/1"
+)
+
+
+class MetricCache(SqliteCache):
+    """
+    Persistent cache of static metric and similarity scores,
+    keyed by content hashes of the evaluated programs and versions
+    of the engines computing the scores, shared between runs and processes
+    """
+
+    def __getstate__(self) -> dict:
+        return {"db_path": self._db_path, "max_size_bytes": self._max_size_bytes}
+
+    def __setstate__(self, state: dict):
+        """Reopen the database in the process receiving the cache"""
+        self.__init__(state["db_path"], state["max_size_bytes"])
+
+    def static_metrics(
+        self, content: str, compute: Callable[[str], StaticMetrics]
+    ) -> StaticMetrics:
+        """
+        Args:
+            content (str): program source code
+            compute (Callable[[str], StaticMetrics]): scores the program on a miss
+
+        Returns:
+            StaticMetrics: cached or freshly computed scores
+        """
+        key = f"static/{STATIC_METRICS_VERSION}/{utils.content_hash(content)}"
+        row = self.get(key)
+        if row is not None:
+            return StaticMetrics(*row)
+        metrics = compute(content)
+        self.put(
+            key,
+            [
+                metrics.cyclomatic_complexity,
+                metrics.halstead_effort,
+                metrics.halstead_bugs,
+                metrics.parseable,
+            ],
+        )
+        return metrics
+
+    def similarity(
+        self,
+        og: str,
+        replica: str,
+        algorithm_names: list[str],
+        compute: Callable[[list[str]], dict[str, float]],
+        variant: str = "",
+        key_contents: tuple[str, str] = None,
+    ) -> dict[str, float]:
+        """
+        Args:
+            og (str): reference program or its fragment
+            replica (str): Tabby completed program or the generated fragment
+            algorithm_names (list[str]): similarity algorithms to score the pair with
+            compute (Callable[[list[str]], dict[str, float]]): scores the pair
+            with the given algorithms on a miss
+            variant (str, optional): settings changing the scores of the algorithms,
+            e.g. bounds of the bounded mode. Defaults to "".
+            key_contents (tuple[str, str], optional): stable representation
+            of the pair to hash instead of og and replica. Defaults to None.
+
+        Returns:
+            dict[str, float]: score of every algorithm, computing only
+            the ones not cached for the pair yet
+        """
+        key_og, key_replica = key_contents or (og, replica)
+        key = (
+            f"similarity/{SIMILARITY_VERSION}{variant}/"
+            f"{utils.content_hash(key_og)}/{utils.content_hash(key_replica)}"
+        )
+        scores = self.get(key) or {}
+        missing = [name for name in algorithm_names if name not in scores]
+        if missing:
+            scores.update(compute(missing))
+            self.put(key, scores)
+        return {name: scores[name] for name in algorithm_names}
+
+
+def open_metric_cache(max_size_mb: int) -> MetricCache:
+    """
+    Args:
+        max_size_mb (int): upper bound for the size of stored scores
+
+    Returns:
+        MetricCache: cache at its default location in the data directory
+    """
+    return MetricCache(
+        utils.get_data_dir() / "cache" / "metrics.sqlite", max_size_mb * 2**20
+    )
@@ -0,0 +1,397 @@
+"""Local stand-in for Tabby's completion endpoint, for benchmarking and testing the query stage offline"""
+
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+
+from pathlib import Path
+from typing import Union
+from contextlib import nullcontext
+from collections.abc import Generator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFILL_FRACTION = 0.3
+
+SYNTHETIC_TOKENS = [
+    "return",
+    "self",
+    "if",
+    "for",
+    "in",
+    "range(n)",
+    "result",
+    "+=",
+    "==",
+    "None",
+    "[]",
+    "len(data)",
+    "\n    ",
+    "\n        ",
+    "(",
+    ")",
+    ":",
+    ",",
+]
+
+
+class LatencyModel:
+    """
+    Distribution of the simulated inference time
+    """
+
+    def __init__(
+        self, distribution: str = "constant", mean: float = 0.1, per_char: float = 0.0
+    ):
+        """
+        Args:
+            distribution (str, optional): one of constant, uniform, exponential,
+            lognormal. Defaults to "constant".
+            mean (float, optional): mean latency in seconds. Defaults to 0.1.
+            per_char (float, optional): additional seconds per character of the prompt,
+            emulating growth of inference time with context size. Defaults to 0.0.
+        """
+        if distribution not in ("constant", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self._distribution = distribution
+        self._mean = mean
+        self._per_char = per_char
+
+    @classmethod
+    def from_spec(cls, spec: str) -> "LatencyModel":
+        """
+        Args:
+            spec (str): distribution:mean[:per_char], e.g. lognormal:0.2:0.00001
+
+        Returns:
+            LatencyModel: parsed latency model
+        """
+        distribution, *params = spec.split(":")
+        return cls(distribution, *map(float, params))
+
+    def sample(self, prompt_length: int) -> float:
+        """
+        Args:
+            prompt_length (int): number of characters in the prompt
+
+        Returns:
+            float: simulated inference time in seconds
+        """
+        if self._distribution == "constant":
+            base = self._mean
+        elif self._distribution == "uniform":
+            base = random.uniform(0, 2 * self._mean)
+        elif self._distribution == "exponential":
+            base = random.expovariate(1 / self._mean)
+        else:
+            sigma = 0.5
+            base = random.lognormvariate(-(sigma**2) / 2, sigma) * self._mean
+        return base + self._per_char * prompt_length
+
+
+class MockTabbyServer:
+    """
+    HTTP server answering /v1/completions with canned or synthetic completions,
+    with configurable latency, error rate, capacity and slow start
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: Union[LatencyModel, None] = None,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        capacity: Union[int, None] = None,
+        slow_start: float = 0.0,
+        completions: Union[list[str], None] = None,
+        streaming: bool = True,
+    ):
+        """
+        Args:
+            host (str, optional): interface to bind. Defaults to "127.0.0.1".
+            port (int, optional): port to bind, 0 picks a free one. Defaults to 0.
+            latency (Union[LatencyModel, None], optional): simulated inference time.
+            Defaults to constant 0.1s.
+            error_rate (float, optional): probability of answering with an error.
+            Defaults to 0.0.
+            error_status (int, optional): status of the error responses.
+            Defaults to 503.
+            capacity (Union[int, None], optional): number of requests processed
+            at the same time, the rest waits in a queue. Defaults to unlimited.
+            slow_start (float, optional): seconds after start during which
+            the server is warming up, rejecting requests with decreasing probability
+            and answering proportionally slower. Defaults to 0.0.
+            completions (Union[list[str], None], optional): canned completions,
+            synthetic ones are generated if not given. Defaults to None.
+            streaming (bool, optional): answer requests asking for a stream
+            with server-sent events. Defaults to True.
+        """
+        self._latency = latency or LatencyModel()
+        self._error_rate = error_rate
+        self._error_status = error_status
+        self._capacity = threading.Semaphore(capacity) if capacity else None
+        self._slow_start = slow_start
+        self._completions = completions
+        self._streaming = streaming
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/completions"
+
+    def start(self) -> "MockTabbyServer":
+        """Serve requests from a background thread"""
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._started_at = time.monotonic()
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "MockTabbyServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _warmup_progress(self) -> float:
+        """
+        Returns:
+            float: 0 right after start, 1 once slow start is over
+        """
+        if self._slow_start <= 0:
+            return 1.0
+        return min(1.0, (time.monotonic() - self._started_at) / self._slow_start)
+
+    def _completion_for(self, prefix: str) -> str:
+        """Pick completion deterministically for the prompt,
+        so repeated requests get identical answers
+
+        Args:
+            prefix (str): code preceding the completion trigger point
+
+        Returns:
+            str: completion text
+        """
+        seed = int.from_bytes(hashlib.sha256(prefix.encode()).digest()[:8], "big")
+        rng = random.Random(seed)
+        if self._completions:
+            return rng.choice(self._completions)
+        return " ".join(rng.choices(SYNTHETIC_TOKENS, k=rng.randint(5, 60)))
+
+    def _should_fail(self) -> bool:
+        warmup = self._warmup_progress()
+        failure_probability = self._error_rate + (1 - warmup) * (1 - self._error_rate)
+        return random.random() < failure_probability
+
+    def _admit(self, request_body: dict) -> tuple[str, bool, float, str]:
+        """Count the request and decide its outcome
+
+        Args:
+            request_body (dict): parsed body of the request
+
+        Returns:
+            tuple[str, bool, float, str]: id of the completion,
+            whether the request fails, simulated inference time and completion text
+        """
+        with self._lock:
+            self.request_count += 1
+            completion_id = f"cmpl-{self.request_count}"
+        prefix = request_body.get("segments", {}).get("prefix", "")
+        if self._should_fail():
+            with self._lock:
+                self.error_count += 1
+            return completion_id, True, 0.0, ""
+        delay = self._latency.sample(len(prefix)) / max(self._warmup_progress(), 0.1)
+        return completion_id, False, delay, self._completion_for(prefix)
+
+    def _processing_slot(self):
+        return self._capacity if self._capacity is not None else nullcontext()
+
+    def complete(self, request_body: dict) -> tuple[int, dict]:
+        """Simulate handling of a completion request
+
+        Args:
+            request_body (dict): parsed body of the request
+
+        Returns:
+            tuple[int, dict]: HTTP status and response body
+        """
+        completion_id, failed, delay, text = self._admit(request_body)
+        if failed:
+            return self._error_status, {"error": "simulated failure"}
+        with self._processing_slot():
+            time.sleep(delay)
+        return 200, {
+            "id": completion_id,
+            "choices": [{"index": 0, "text": text}],
+        }
+
+    def complete_streaming(
+        self, request_body: dict
+    ) -> tuple[int, Union[dict, Generator[dict]]]:
+        """Simulate handling of a streamed completion request,
+        emitting the first token after the prefill part of the inference time
+        and the rest of them evenly over the remaining part
+
+        Args:
+            request_body (dict): parsed body of the request
+
+        Returns:
+            tuple[int, Union[dict, Generator[dict]]]: HTTP status and either
+            the error body or the generator of completion events
+        """
+        completion_id, failed, delay, text = self._admit(request_body)
+        if failed:
+            return self._error_status, {"error": "simulated failure"}
+
+        def events() -> Generator[dict]:
+            tokens = re.findall(r"\S+\s*|\s+", text) or [""]
+            with self._processing_slot():
+                time.sleep(delay * PREFILL_FRACTION)
+                for token in tokens:
+                    time.sleep(delay * (1 - PREFILL_FRACTION) / len(tokens))
+                    yield {
+                        "id": completion_id,
+                        "choices": [{"index": 0, "text": token}],
+                    }
+
+        return 200, events()
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out as separate writes on kept-alive
+            # connections, Nagle's algorithm would hold the body back
+            # until the client's delayed ACK, adding ~40ms per response
+            disable_nagle_algorithm = True
+
+            def _send_json(self, status: int, body: dict):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == "/v1/health":
+                    self._send_json(
+                        200,
+                        {"model": "mock", "version": {"git_describe": "mock"}},
+                    )
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.path != "/v1/completions":
+                    self._send_json(404, {"error": "not found"})
+                    return
+                try:
+                    request_body = json.loads(body)
+                except ValueError:
+                    self._send_json(400, {"error": "malformed request body"})
+                    return
+                if request_body.get("stream") and server._streaming:
+                    self._send_events(*server.complete_streaming(request_body))
+                else:
+                    self._send_json(*server.complete(request_body))
+
+            def _send_events(self, status: int, events: Union[dict, Generator[dict]]):
+                if status != 200:
+                    self._send_json(status, events)
+                    return
+                self.send_response(status)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for event in events:
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve a mock Tabby completion API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency",
+        default="constant:0.1",
+        help="distribution:mean[:per_char] with distribution one of "
+        "constant, uniform, exponential, lognormal",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument(
+        "--capacity", type=int, help="requests processed at the same time"
+    )
+    parser.add_argument(
+        "--slow-start", type=float, default=0.0, help="warm-up period in seconds"
+    )
+    parser.add_argument(
+        "--completions",
+        type=Path,
+        help="JSON file with a list of canned completions",
+    )
+    parser.add_argument(
+        "--no-streaming",
+        action="store_true",
+        help="ignore stream requests and always answer with a single JSON body",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    completions = None
+    if args.completions is not None:
+        completions = json.loads(args.completions.read_text())
+    server = MockTabbyServer(
+        args.host,
+        args.port,
+        LatencyModel.from_spec(args.latency),
+        args.error_rate,
+        args.error_status,
+        args.capacity,
+        args.slow_start,
+        completions,
+        not args.no_streaming,
+    )
+    print(f"Mock Tabby server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
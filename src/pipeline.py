@@ -0,0 +1,494 @@
+"""Incremental runner of the whole pipeline, modelling it as per-file tasks that are re-run, the way make does, only when the hash of their inputs changed"""
+
+import os
+import argparse
+import importlib
+import threading
+
+from pathlib import Path
+from dotenv import load_dotenv
+from collections.abc import Callable
+
+import const
+import utils
+from manifest import CorpusManifest, ManifestEntry, load_manifest
+from completion_feed import CompletionFeed
+from completion_store import CompletionStore, STORAGE_KINDS, open_completion_store
+from metric_cache import STATIC_METRICS_VERSION, SIMILARITY_VERSION, open_metric_cache
+from results_store import (
+    SIMILARITY_RESULTS,
+    STATIC_RESULTS,
+    ResultsStore,
+    open_results_store,
+)
+from task_state import TaskState, combined_hash, sources_hash
+
+sort_data = importlib.import_module("sort_data-1")
+query_server = importlib.import_module("query_server-2")
+StaticTester = importlib.import_module("static_tester-3").StaticTester
+SimilarityTester = importlib.import_module("similarity_tester-3").SimilarityTester
+
+QUERY = "query"
+STATIC = "static"
+SIMILARITY = "similarity"
+PLOT = "plot"
+
+STATE_DB = "pipeline_state.sqlite"
+# setting recorded by every run, a dry run compares with it without asking the server
+SERVER_TAG = "server_tag"
+
+# source files whose changes invalidate the results of a stage
+STAGE_SOURCES = {
+    QUERY: ["query_server-2.py", "prefix_generator.py"],
+    STATIC: ["static_tester-3.py", "static_metrics.py"],
+    SIMILARITY: [
+        "similarity_tester-3.py",
+        "similarity_engine.py",
+        "similarity_algorithms.py",
+        "token_sequences.py",
+    ],
+    PLOT: ["make_plot-4.py"],
+}
+
+
+def stage_version(stage: str, settings: str) -> str:
+    """
+    Args:
+        stage (str): pipeline stage
+        settings (str): configuration changing the results of the stage
+
+    Returns:
+        str: hash of the stage's code and configuration
+    """
+    src_dir = Path(__file__).resolve().parent
+    return combined_hash(
+        sources_hash([src_dir / name for name in STAGE_SOURCES[stage]]), settings
+    )
+
+
+class Pipeline:
+    """
+    Dependency graph of per-file tasks: querying a reference file,
+    then static evaluation and similarity testing of its completions,
+    followed by plotting of all results. Each task is run again only
+    if the reference file, the completions it depends on,
+    or the code and configuration of its stage changed
+    """
+
+    def __init__(
+        self,
+        task_state: TaskState,
+        sorter: "sort_data.DataSorter",
+        completion_store: CompletionStore,
+        results_stores: list[ResultsStore],
+        fetcher: "query_server.TabbySuggestionsFetcher",
+        static_tester: StaticTester,
+        similarity_tester: SimilarityTester,
+        settings: dict[str, str],
+    ):
+        """
+        Args:
+            task_state (TaskState): record of completed tasks
+            sorter (DataSorter): sorting of the raw dataset into the sorted database
+            completion_store (CompletionStore): destination of autocompletions
+            results_stores (list[ResultsStore]): stores of the testing stages
+            fetcher (TabbySuggestionsFetcher): query stage
+            static_tester (StaticTester): static evaluation stage
+            similarity_tester (SimilarityTester): similarity testing stage,
+            the stores and stages are not used in a dry run and may be None
+            settings (dict[str, str]): configuration of every stage
+        """
+        self._task_state = task_state
+        self._sorter = sorter
+        self._completion_store = completion_store
+        self._results_stores = results_stores
+        self._fetcher = fetcher
+        self._testers = {STATIC: static_tester, SIMILARITY: similarity_tester}
+        self._versions = {
+            stage: stage_version(stage, settings.get(stage, ""))
+            for stage in STAGE_SOURCES
+        }
+        self._sorted_dir_path = utils.get_data_dir() / "sorted"
+
+    def run(self, dry_run: bool = False, fused: bool = False):
+        """Bring all results up to date with the raw dataset,
+        the sorted database is always refreshed first
+
+        Args:
+            dry_run (bool, optional): only report the tasks that are out of date,
+            judged by a read-only scan of the raw dataset. Defaults to False.
+            fused (bool, optional): evaluate re-queried files while the others
+            are still being fetched. Defaults to False.
+        """
+        if dry_run:
+            entries, aliases = self._sorter.plan(persist=False)
+            manifest = CorpusManifest.from_entries(self._sorted_dir_path, entries)
+            print(
+                f"Sorting skipped in dry run, {len(entries)} files would be sorted, "
+                f"{len(aliases)} duplicates"
+            )
+        else:
+            self._sorter.run()
+            manifest = load_manifest(self._sorted_dir_path)
+        removed = self._removed_files(manifest)
+        stale_queries = self._stale(QUERY, manifest, self._query_inputs)
+        if dry_run:
+            print(f"{len(removed)} files removed")
+            print(f"{QUERY}: {len(stale_queries)} of {len(manifest)} tasks to run")
+            for stage in self._testers:
+                stale = self._stale(stage, manifest, self._tester_inputs)
+                print(
+                    f"{stage}: {len(stale)} of {len(manifest)} tasks to run, "
+                    "more if re-queried completions change"
+                )
+            return
+        for relative_path in removed:
+            self._remove(relative_path)
+        if fused:
+            self._run_fused(stale_queries, manifest)
+        else:
+            self._run_queries(stale_queries)
+        for stage, tester in self._testers.items():
+            stale = self._stale(stage, manifest, self._tester_inputs)
+            if stale or removed:
+                # an empty run still refreshes the stage summary after removals
+                failed = set(tester.run([fpath for fpath, _ in stale]))
+                for fpath, input_hash in stale:
+                    if fpath not in failed:
+                        self._task_state.record(stage, self._key(fpath), input_hash)
+        self._run_plots(manifest)
+
+    def _key(self, fpath: Path) -> str:
+        return fpath.relative_to(self._sorted_dir_path).as_posix()
+
+    def _query_inputs(self, stage: str, entry: ManifestEntry) -> str:
+        return combined_hash(self._versions[stage], entry.sha256)
+
+    def _tester_inputs(self, stage: str, entry: ManifestEntry) -> str:
+        recorded_query = self._task_state.get(QUERY, entry.relative_path)
+        if recorded_query is None:
+            # completions of the file are not available yet
+            return None
+        return combined_hash(self._versions[stage], entry.sha256, recorded_query[1])
+
+    def _stale(
+        self,
+        stage: str,
+        manifest: CorpusManifest,
+        inputs: Callable[[str, ManifestEntry], str],
+    ) -> list[tuple[Path, str]]:
+        """
+        Args:
+            stage (str): pipeline stage
+            manifest (CorpusManifest): current files of the sorted database
+            inputs (Callable[[str, ManifestEntry], str]): hash of the inputs
+            of the stage's task for a file, None if they are not ready
+
+        Returns:
+            list[tuple[Path, str]]: reference files whose task is out of date,
+            with the hash of its current inputs
+        """
+        stale = []
+        for entry in manifest:
+            input_hash = inputs(stage, entry)
+            if input_hash is not None and not self._task_state.is_current(
+                stage, entry.relative_path, input_hash
+            ):
+                stale.append((manifest.root_path / entry.relative_path, input_hash))
+        return stale
+
+    def _removed_files(self, manifest: CorpusManifest) -> set[str]:
+        recorded = set()
+        for stage in (QUERY, *self._testers):
+            recorded |= self._task_state.files(stage)
+        return {file for file in recorded if manifest.get(file) is None}
+
+    def _remove(self, relative_path: str):
+        """Drop all outputs of a file no longer in the sorted database"""
+        self._completion_store.discard(Path(relative_path))
+        for results_store in self._results_stores:
+            results_store.remove(Path(relative_path))
+        for stage in (QUERY, *self._testers):
+            self._task_state.forget(stage, relative_path)
+
+    def _run_queries(self, stale: list[tuple[Path, str]]):
+        if not stale:
+            return
+        self._discard_completions(stale)
+        self._fetcher.run([fpath for fpath, _ in stale])
+        self._record_queries(stale)
+
+    def _run_fused(self, stale: list[tuple[Path, str]], manifest: CorpusManifest):
+        """Query the files and pass each one to the testing stages
+        as soon as all of its completions arrive, so that evaluation
+        overlaps with waiting for the server
+
+        Args:
+            stale (list[tuple[Path, str]]): files to query with their input hashes
+            manifest (CorpusManifest): current files of the sorted database
+        """
+        if not stale:
+            return
+        self._discard_completions(stale)
+        feed = CompletionFeed(len(self._testers))
+        failed: dict[str, set[Path]] = {}
+        errors: list[Exception] = []
+
+        def evaluate(consumer: int, stage: str):
+            try:
+                failed[stage] = set(self._testers[stage].run(feed.consume(consumer)))
+            except Exception as e:
+                errors.append(e)
+                feed.abandon(consumer)
+
+        threads = [
+            threading.Thread(target=evaluate, args=(consumer, stage))
+            for consumer, stage in enumerate(self._testers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            self._fetcher.run([fpath for fpath, _ in stale], on_file_done=feed.put)
+        finally:
+            feed.close()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        self._record_queries(stale)
+        for stage, stage_failed in failed.items():
+            for fpath, _ in stale:
+                if fpath in stage_failed or fpath in self._fetcher.failed_files:
+                    continue
+                self._task_state.record(
+                    stage,
+                    self._key(fpath),
+                    self._tester_inputs(stage, manifest.get(self._key(fpath))),
+                )
+
+    def _discard_completions(self, stale: list[tuple[Path, str]]):
+        for fpath, _ in stale:
+            # completions of earlier prefix ratios must not outlive the new run
+            self._task_state.forget(QUERY, self._key(fpath))
+            self._completion_store.discard(fpath.relative_to(self._sorted_dir_path))
+
+    def _record_queries(self, stale: list[tuple[Path, str]]):
+        for fpath, input_hash in stale:
+            if fpath in self._fetcher.failed_files:
+                continue
+            self._task_state.record(
+                QUERY, self._key(fpath), input_hash, self._completions_hash(fpath)
+            )
+
+    def _completions_hash(self, fpath: Path) -> str:
+        """
+        Args:
+            fpath (Path): reference file path
+
+        Returns:
+            str: hash of all completions of the file, the input
+            of the testing stages, which may stay the same after re-querying
+        """
+        parts = []
+        for prefix_ratio, completion in self._completion_store.next_completion(
+            fpath.relative_to(self._sorted_dir_path), utils.load_file(fpath)
+        ):
+            parts += [str(prefix_ratio), completion]
+        return combined_hash(*parts)
+
+    def _run_plots(self, manifest: CorpusManifest):
+        task_hashes = []
+        for entry in manifest:
+            for stage in self._testers:
+                recorded = self._task_state.get(stage, entry.relative_path)
+                task_hashes.append(recorded[0] if recorded is not None else "")
+        input_hash = combined_hash(self._versions[PLOT], *task_hashes)
+        if self._task_state.is_current(PLOT, "", input_hash):
+            return
+        importlib.import_module("make_plot-4").make_plots(similarity=True)
+        self._task_state.record(PLOT, "", input_hash)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run the stages whose inputs changed since their last run"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the number of out of date tasks per stage",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="evaluate files while others are still being queried, "
+        "overlapping network waits with computation",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_KINDS,
+        default=const.DEFAULT_COMPLETION_STORAGE,
+        help="save full autocompleted files, or only split offsets and completions",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=const.DEFAULT_CONCURRENCY,
+        help="maximum number of requests in flight",
+    )
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        help="completion url of a Tabby replica, repeat to balance across several, "
+        f"defaults to {const.TABBY_URL}",
+    )
+    parser.add_argument(
+        "--cache-tag",
+        help="server/model identifier, detected from the health endpoint by default; "
+        "completions of another server are queried again",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of evaluating processes, 1 runs in the current process",
+    )
+    parser.add_argument(
+        "--extensions",
+        default="py",
+        help="comma separated file extensions of the raw dataset to keep",
+    )
+    parser.add_argument(
+        "--link",
+        choices=sort_data.LINK_MODES,
+        default="copy",
+        help="place sorted files as copies, hardlinks or copy-on-write reflinks",
+    )
+    parser.add_argument(
+        "--sort-workers",
+        type=int,
+        help="number of threads stating, hashing and copying files while sorting",
+    )
+    parser.add_argument(
+        "--algorithms",
+        help="comma separated similarity algorithms to run, all by default",
+    )
+    parser.add_argument(
+        "--tokens",
+        action="store_true",
+        help="compare sequences of Python tokens instead of characters",
+    )
+    return parser.parse_args()
+
+
+def stage_settings(
+    args: argparse.Namespace, server_tag: str, similarity_settings: str
+) -> dict[str, str]:
+    """
+    Args:
+        args (argparse.Namespace): command line options
+        server_tag (str): server/model identifier
+        similarity_settings (str): settings of the similarity tester
+
+    Returns:
+        dict[str, str]: configuration of every stage
+    """
+    return {
+        QUERY: f"{const.SPLIT_RATIO_STEP}/{const.DEFAULT_LANGUAGE}/"
+        f"{args.storage}/{server_tag}",
+        STATIC: STATIC_METRICS_VERSION,
+        SIMILARITY: f"{SIMILARITY_VERSION}/{similarity_settings}",
+    }
+
+
+def dry_run(args: argparse.Namespace, sorter: "sort_data.DataSorter"):
+    """Report the out of date tasks without creating or changing any file
+    and without contacting the server
+
+    Args:
+        args (argparse.Namespace): command line options
+        sorter (DataSorter): sorting of the raw dataset
+    """
+    task_state = TaskState(utils.get_data_dir() / STATE_DB, read_only=True)
+    server_tag = args.cache_tag or task_state.setting(SERVER_TAG)
+    if server_tag is None:
+        print("Server of the last run unknown, pass --cache-tag to compare with it")
+        server_tag = ""
+    similarity_tester = SimilarityTester(
+        None,
+        None,
+        tokens=args.tokens,
+        algorithm_names=args.algorithms.split(",") if args.algorithms else None,
+    )
+    pipeline = Pipeline(
+        task_state,
+        sorter,
+        None,
+        [],
+        None,
+        None,
+        None,
+        stage_settings(args, server_tag, similarity_tester.settings),
+    )
+    pipeline.run(dry_run=True)
+    task_state.close()
+
+
+def main():
+    args = parse_args()
+    sorter = sort_data.DataSorter(
+        utils.get_data_dir() / "raw",
+        utils.get_data_dir() / "sorted",
+        args.extensions.split(","),
+        args.link,
+        args.sort_workers,
+    )
+    if args.dry_run:
+        dry_run(args, sorter)
+        return
+    load_dotenv()
+    auth_token = os.getenv("tabby_auth_token")
+    endpoints = args.endpoint or [const.TABBY_URL]
+    connection = query_server.open_tabby_connection(
+        endpoints, auth_token, cache_tag=args.cache_tag
+    )
+    server_tag = args.cache_tag or connection.server_tag()
+    task_state = TaskState(utils.get_data_dir() / STATE_DB)
+    completion_store = open_completion_store(args.storage)
+    static_store = open_results_store(STATIC_RESULTS)
+    similarity_store = open_results_store(SIMILARITY_RESULTS)
+    metric_cache = open_metric_cache(const.METRIC_CACHE_MAX_SIZE_MB)
+    similarity_tester = SimilarityTester(
+        similarity_store,
+        completion_store,
+        metric_cache,
+        args.workers,
+        tokens=args.tokens,
+        algorithm_names=args.algorithms.split(",") if args.algorithms else None,
+    )
+    pipeline = Pipeline(
+        task_state,
+        sorter,
+        completion_store,
+        [static_store, similarity_store],
+        query_server.TabbySuggestionsFetcher(
+            connection,
+            utils.get_data_dir() / "sorted",
+            completion_store,
+            const.SPLIT_RATIO_STEP,
+            const.DEFAULT_LANGUAGE,
+            args.concurrency,
+        ),
+        StaticTester(static_store, completion_store, args.workers, metric_cache),
+        similarity_tester,
+        stage_settings(args, server_tag, similarity_tester.settings),
+    )
+    pipeline.run(fused=args.fused)
+    task_state.record_setting(SERVER_TAG, server_tag)
+    for store in (static_store, similarity_store, completion_store, metric_cache):
+        store.close()
+    task_state.close()
+
+
+if __name__ == "__main__":
+    main()
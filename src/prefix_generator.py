@@ -6,6 +6,15 @@ PERCENT_RANGE_START = 0
 PERCENT_RANGE_END = 1
 
 
+def split_ratios(split_ratio_step: float) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray: prefix ratios produced for the given step,
+        excluding the empty prefix
+    """
+    return np.arange(PERCENT_RANGE_START, PERCENT_RANGE_END, split_ratio_step)[1:]
+
+
 class PrefixGenerator:
     """
     Generator for prefixes of text by given percentage step
@@ -27,9 +36,7 @@ class PrefixGenerator:
             )
 
     def next_prefix(self) -> tuple[float, str, str]:
-        for ratio in np.arange(
-            PERCENT_RANGE_START, PERCENT_RANGE_END, self._split_ratio_step
-        )[1:]:
+        for ratio in split_ratios(self._split_ratio_step):
             yield ratio, *self._split_by_ratio(ratio)
 
     def _split_by_ratio(self, ratio: float) -> tuple[str, str]:
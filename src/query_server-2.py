@@ -1,15 +1,26 @@
 import time
 import os
+import argparse
+import json
+import threading
+from typing import Union
 from tqdm import tqdm
 import requests
 from pathlib import Path
 from dotenv import load_dotenv
-from collections.abc import Generator
+from collections.abc import Callable, Generator
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
 
 import const
 import utils
 from tabby_connection import TabbyConnection
-from prefix_generator import PrefixGenerator
+from completion_cache import CompletionCache
+from endpoint_pool import EndpointPool
+from completion_store import CompletionStore, STORAGE_KINDS, open_completion_store
+from rate_controller import AdaptiveRateController
+from request_log import RequestLog, RequestRecord
+from prefix_generator import PrefixGenerator, split_ratios
+from manifest import load_manifest
 
 
 class TabbySuggestionsFetcher:
@@ -24,125 +35,470 @@ class TabbySuggestionsFetcher:
         self,
         tabby_connection: TabbyConnection,
         in_dir_path: Path,
-        out_dir_path: Path,
+        completion_store: CompletionStore,
         split_ratio_step: float,
         language: str,
+        concurrency: int = const.DEFAULT_CONCURRENCY,
+        report_dir_path: Union[Path, None] = None,
     ):
         """
         Args:
             tabby_connection (TabbyConnection): api connection utility
             in_dir_path (Path): sorted database
-            out_dir_path (Path): _description_
-            split_ratio_step (float): _description_
-            language (str): _description_
-            verbose (bool, optional): _description_. Defaults to True.
+            completion_store (CompletionStore): destination for autocompletions
+            split_ratio_step (float): step between consecutive prefix ratios
+            language (str): programming language of the prompts
+            concurrency (int, optional): maximum number of requests in flight,
+            the rate controller adapts the actual number below it.
+            Defaults to const.DEFAULT_CONCURRENCY.
+            report_dir_path (Union[Path, None], optional): directory for
+            the request log, timing report and dead-letter file of prompts
+            that kept failing. Defaults to the data directory.
         """
+        if concurrency < 1:
+            raise ValueError("Concurrency has to be a positive number of requests")
         self._tabby_connection = tabby_connection
         self._in_dir_path = in_dir_path
-        self._out_dir_path = out_dir_path
+        self._completion_store = completion_store
         self._split_ratio_step = split_ratio_step
         self._language = language
+        self._concurrency = concurrency
+        self._thread_local = threading.local()
+        self._rate_controller = AdaptiveRateController(concurrency)
+        self._report_dir_path = report_dir_path or utils.get_data_dir()
+        self._dead_letter_path = self._report_dir_path / "dead_letter.jsonl"
+        self._dead_letter_lock = threading.Lock()
+        self._skipped = 0
+        self.failed_files: set[Path] = set()
+        self._on_file_done = None
+        self._pending_prompts: dict[Path, int] = {}
+        self._pending_lock = threading.Lock()
 
-    def _total_file_count(self) -> int:
+    def _next_request(
+        self, paths: list[Path]
+    ) -> Generator[tuple[Path, float, str, str]]:
         """
-        Returns:
-            int: total number of files in input directory
+        Args:
+            paths (list[Path]): reference files to query
+
+        Yields:
+            Generator[tuple[Path, float, str, str]]: reference file path,
+            prefix ratio and prefix for every prompt to be sent,
+            with the content hash of the reference file
         """
-        total = 0
-        for root, dirs, files in os.walk(self._in_dir_path):
-            total += len(files)
-        return total
+        for fpath in paths:
+            content = utils.load_file(fpath)
+            og_sha256 = utils.content_hash(content)
+            prefix_gen = PrefixGenerator(content, self._split_ratio_step)
+            for ratio, prefix, _ in prefix_gen.next_prefix():
+                yield fpath, ratio, prefix, og_sha256
 
-    def _next_filepath(self) -> Generator[Path]:
+    def _connection(self) -> TabbyConnection:
         """
-        Yields:
-            Generator[Path]: next path from input directory
+        Returns:
+            TabbyConnection: connection owned by the calling worker thread
         """
-        for fpath in self._in_dir_path.rglob("*"):
-            if fpath.is_file():
-                yield fpath
+        connection = getattr(self._thread_local, "connection", None)
+        if connection is None:
+            connection = self._tabby_connection.clone()
+            self._thread_local.connection = connection
+        return connection
 
-    def run(self):
+    def run(
+        self,
+        paths: list[Path] = None,
+        on_file_done: Callable[[Path], None] = None,
+    ) -> dict:
         """
-        Main loop iterating over files
-        and saving new version with completion
-        for each prefix
+        Main loop keeping up to `concurrency` requests in flight
+        across files and prefix ratios, saving new version
+        with completion for each prefix as soon as it arrives
+
+        Args:
+            paths (list[Path], optional): reference files to query.
+            Defaults to all files of the sorted database.
+            on_file_done (Callable[[Path], None], optional): called from
+            the requesting threads with every reference file once all of its
+            prompts were completed or given up, may block to slow the requests
+            down. Defaults to None.
+
+        Returns:
+            dict: timing and latency summary of the run
         """
+        self._request_log = RequestLog(self._report_dir_path / "requests_log.jsonl")
+        if paths is None:
+            paths = list(load_manifest(self._in_dir_path).paths())
+        self.failed_files.clear()
+        self._on_file_done = on_file_done
+        prompts_per_file = len(split_ratios(self._split_ratio_step))
+        self._pending_prompts = dict.fromkeys(paths, prompts_per_file)
+        request_count = 0
         start = time.perf_counter()
-        for fpath in tqdm(
-            self._next_filepath(),
-            desc="Fetching autocompletions",
-            total=self._total_file_count(),
-            leave=False,
-        ):
-            og_content = utils.load_file(fpath)
-            prefix_gen = PrefixGenerator(utils.load_file(fpath), self._split_ratio_step)
-            for ratio, prefix, _ in tqdm(
-                prefix_gen.next_prefix(),
-                desc=f"{fpath.parent.name}/{fpath.name}",
-                total=9,
+        with (
+            ThreadPoolExecutor(max_workers=self._concurrency) as executor,
+            tqdm(
+                desc="Fetching autocompletions",
+                total=len(paths) * prompts_per_file,
+                unit="req",
                 leave=False,
-            ):
-                first_suggestion = ""
-                response_data = self._await_request_response(prefix)
-                first_suggestion = response_data["choices"][0]["text"]
-                prefix += first_suggestion
-                self._save_tabby_completed_code(fpath, ratio, prefix)
-
-        end = time.perf_counter()
-        benchmark_msg = "Total time: {:.sf}s".format(end - start)
+            ) as progress,
+        ):
+            in_flight: set[Future] = set()
+            for fpath, ratio, prefix, og_sha256 in self._next_request(paths):
+                if len(in_flight) >= self._concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    request_count += self._collect(done, progress)
+                in_flight.add(
+                    executor.submit(
+                        self._fetch_and_save,
+                        fpath,
+                        ratio,
+                        prefix,
+                        og_sha256,
+                        time.perf_counter(),
+                    )
+                )
+            request_count += self._collect(wait(in_flight).done, progress)
+        self._request_log.close()
+
+        total_time = time.perf_counter() - start
+        report = {
+            "total_time": round(total_time, 4),
+            "requests": request_count,
+            "requests_per_second": round(request_count / total_time, 4),
+            "max_concurrency": self._concurrency,
+            "final_concurrency_limit": self._rate_controller.limit,
+            "congestion_events": self._rate_controller.congestion_events,
+            "skipped": self._skipped,
+            **self._request_log.summary(),
+        }
+        report["endpoints"] = self._tabby_connection.endpoint_pool.stats()
+        if self._tabby_connection.cache is not None:
+            report["cache"] = self._tabby_connection.cache.stats()
+        self._write_report(report)
+        return report
+
+    def _write_report(self, report: dict):
+        """Print headline numbers and save the full report
+
+        Args:
+            report (dict): timing and latency summary of the run
+        """
         tqdm.write("Fetching autocompletions done!")
-        tqdm.write(benchmark_msg)
+        tqdm.write(
+            "Total time: {:.2f}s, throughput: {:.2f} req/s".format(
+                report["total_time"], report["requests_per_second"]
+            )
+        )
+        for group, summary in [
+            ("overall", report["overall"]),
+            *report["by_prefix_ratio"].items(),
+        ]:
+            if "server_latency" in summary:
+                tqdm.write(
+                    "{:>8} n={:<6} server latency p50/p90/p99: {p50}/{p90}/{p99}s".format(
+                        group, summary["count"], **summary["server_latency"]
+                    )
+                )
+        if "first_token_latency" in report["overall"]:
+            tqdm.write(
+                "time to first token p50/p90/p99: {p50}/{p90}/{p99}s".format(
+                    **report["overall"]["first_token_latency"]
+                )
+            )
+        for url, stats in report["endpoints"].items():
+            tqdm.write(f"{url}: {stats}")
+        if self._skipped:
+            tqdm.write(f"Skipped {self._skipped} prompts, see {self._dead_letter_path}")
+        if "cache" in report:
+            tqdm.write(f"Cache: {report['cache']}")
         utils.write_to_file(
-            utils.get_data_dir() / "requests_timing.json", benchmark_msg
+            self._report_dir_path / "requests_timing.json",
+            json.dumps(report, indent=2),
         )
 
-    def _await_request_response(self, prefix: str):
+    def _collect(self, done: set[Future], progress: tqdm) -> int:
+        """Surface errors of finished requests and advance the progress bar
+
+        Args:
+            done (set[Future]): finished requests
+            progress (tqdm): progress bar of the run
+
+        Returns:
+            int: number of collected requests
+        """
+        for future in done:
+            future.result()
+        progress.update(len(done))
+        progress.set_postfix(limit=self._rate_controller.limit, skipped=self._skipped)
+        return len(done)
+
+    def _fetch_and_save(
+        self,
+        fpath: Path,
+        ratio: float,
+        prefix: str,
+        og_sha256: str,
+        submitted_at: float,
+    ):
+        """Retrieve completion of a single prompt, save the completed file
+        and log measurements of the request
+
+        Args:
+            fpath (Path): path of currently processed reference file
+            ratio (float): ratio of the current split
+            prefix (str): prefix generated with ratio
+            og_sha256 (str): content hash of the reference file
+            submitted_at (float): performance counter value at submission
+        """
+        record = RequestRecord(
+            file=str(fpath.relative_to(self._in_dir_path)),
+            prefix_ratio=int(ratio * 100),
+            prefix_length=len(prefix),
+        )
+        try:
+            first_suggestion = self._await_request_response(
+                prefix, record, submitted_at
+            )
+            if first_suggestion is not None:
+                record.completion_length = len(first_suggestion)
+                self._save_tabby_completed_code(
+                    fpath, ratio, og_sha256, prefix, first_suggestion
+                )
+            record.total_time = time.perf_counter() - submitted_at
+            self._request_log.add(record)
+        finally:
+            self._prompt_done(fpath)
+
+    def _prompt_done(self, fpath: Path):
+        """Count down the prompts of the file, passing it on after the last one
+
+        Args:
+            fpath (Path): path of currently processed reference file
+        """
+        with self._pending_lock:
+            self._pending_prompts[fpath] -= 1
+            file_done = self._pending_prompts[fpath] == 0
+        if file_done and self._on_file_done is not None:
+            self._on_file_done(fpath)
+
+    def _await_request_response(
+        self, prefix: str, record: RequestRecord, submitted_at: float
+    ) -> Union[str, None]:
         """Accommodates for possible timeouts of the server,
-        given the potential intensity and frequency of the requests
+        retrying under the pace set by the rate controller
+        until the attempts or the deadline of the request run out;
+        a malformed response sends the prompt to the dead-letter file right away
 
         Args:
             prefix (str): prefix to be used for the request
+            record (RequestRecord): measurements of the request to fill
+            submitted_at (float): performance counter value at submission
+
+        Returns:
+            Union[str, None]: text of the first suggestion,
+            or None if the prompt was moved to the dead-letter file
         """
-        while True:
+        deadline = time.monotonic() + const.REQUEST_DEADLINE
+        for attempt in range(1, const.REQUEST_MAX_ATTEMPTS + 1):
+            record.retries = attempt - 1
+            record.status, record.server_latency, error = None, None, None
+            record.first_byte_latency, record.first_token_latency = None, None
+            self._rate_controller.acquire()
+            start = time.perf_counter()
+            if attempt == 1:
+                record.queue_wait = start - submitted_at
             try:
-                response_data = self._tabby_connection.get_suggestion(
-                    self._language, prefix
+                response_data = self._connection().get_suggestion(
+                    self._language,
+                    prefix,
+                    timeout=(
+                        const.CONNECT_TIMEOUT,
+                        max(1.0, min(const.READ_TIMEOUT, deadline - time.monotonic())),
+                    ),
+                    record=record,
                 )
-                return response_data
+                if record.server_latency is None:
+                    record.status, record.cached = 200, True
+                return response_data["choices"][0]["text"]
             except requests.HTTPError as e:
-                time.sleep(const.REQUESTS_TIMEOUT)
+                record.status, error = e.response.status_code, e
+            except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                # undecodable body or one without a suggestion, not worth retrying
+                error = e
+                break
+            except requests.RequestException as e:
+                error = e
+            finally:
+                # cache hits say nothing about the load of the server
+                self._rate_controller.release(
+                    None if record.cached else time.perf_counter() - start,
+                    record.status,
+                    len(prefix),
+                )
+
+            if 400 <= (record.status or 0) < 500 and record.status not in (408, 429):
+                break
+            delay = self._rate_controller.backoff(
+                attempt, const.RETRY_BACKOFF_BASE, const.RETRY_BACKOFF_MAX
+            )
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+        self._write_dead_letter(record, error)
+        return None
+
+    def _write_dead_letter(self, record: RequestRecord, error: Exception):
+        """Record a prompt that could not be completed
+
+        Args:
+            record (RequestRecord): measurements of the failed request
+            error (Exception): last error raised by the request
+        """
+        entry = {
+            "file": record.file,
+            "prefix_ratio": record.prefix_ratio,
+            "prefix_length": record.prefix_length,
+            "attempts": record.retries + 1,
+            "error": repr(error),
+        }
+        with self._dead_letter_lock:
+            self._skipped += 1
+            self.failed_files.add(self._in_dir_path / record.file)
+            self._dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self._dead_letter_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
 
-    def _save_tabby_completed_code(self, fpath: Path, ratio: float, content: str):
-        """Saves Tabby completed prefix to a file,
-        ordered in folders by prefix ratio
+    def _save_tabby_completed_code(
+        self, fpath: Path, ratio: float, og_sha256: str, prefix: str, completion: str
+    ):
+        """Saves Tabby completed prefix to the completion store,
+        ordered by prefix ratio
 
         Args:
             fpath (Path): path of currently processed reference file
             ratio (float): ratio of the current split
-            content (str): prefix generated with ratio, autocompleted by Tabby
+            og_sha256 (str): content hash of the reference file
+            prefix (str): prefix generated with ratio
+            completion (str): text generated by Tabby for the prefix
         """
-        dest_fpath = (
-            self._out_dir_path
-            / f"prefix-ratio-{int(ratio * 100)}"
-            / fpath.relative_to(self._in_dir_path)
+        self._completion_store.save(
+            fpath.relative_to(self._in_dir_path),
+            int(ratio * 100),
+            og_sha256,
+            prefix,
+            completion,
         )
-        utils.write_to_file(dest_fpath, content)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fetch Tabby autocompletions")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=const.DEFAULT_CONCURRENCY,
+        help="maximum number of requests in flight",
+    )
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        help="completion url of a Tabby replica, repeat to balance across several, "
+        f"defaults to {const.TABBY_URL}",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_KINDS,
+        default=const.DEFAULT_COMPLETION_STORAGE,
+        help="save full autocompleted files, or only split offsets and completions",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read completions incrementally as server-sent events, "
+        "measuring time to first token",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always query the server, bypassing the completion cache",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default=const.COMPLETION_CACHE_MAX_SIZE_MB,
+        help="size bound of the completion cache",
+    )
+    parser.add_argument(
+        "--cache-tag",
+        help="server/model identifier for cache keys, "
+        "detected from the health endpoint by default",
+    )
+    return parser.parse_args()
+
+
+def open_tabby_connection(
+    endpoints: list[str],
+    auth_token: str,
+    stream: bool = False,
+    cache_size_mb: Union[int, None] = const.COMPLETION_CACHE_MAX_SIZE_MB,
+    cache_tag: Union[str, None] = None,
+) -> TabbyConnection:
+    """
+    Args:
+        endpoints (list[str]): completion urls of Tabby replicas
+        auth_token (str): Tabby authorization token
+        stream (bool, optional): read completions as server-sent events.
+        Defaults to False.
+        cache_size_mb (Union[int, None], optional): size bound of the completion
+        cache, None to always query the server.
+        Defaults to const.COMPLETION_CACHE_MAX_SIZE_MB.
+        cache_tag (Union[str, None], optional): server/model identifier
+        for cache keys, detected from the health endpoint by default.
+
+    Returns:
+        TabbyConnection: connection balancing requests across the endpoints
+    """
+    cache = None
+    if cache_size_mb is not None:
+        server_tag = cache_tag or TabbyConnection(endpoints, auth_token).server_tag()
+        cache = CompletionCache(
+            utils.get_data_dir() / "cache" / "completions.sqlite",
+            cache_size_mb * 2**20,
+            server_tag,
+        )
+    return TabbyConnection(
+        EndpointPool(
+            endpoints,
+            const.ENDPOINT_FAILURE_THRESHOLD,
+            const.ENDPOINT_EJECTION_PERIOD,
+        ),
+        auth_token,
+        cache,
+        stream,
+    )
 
 
 def main():
+    args = parse_args()
     load_dotenv()
-    tabby_auth_token = os.getenv("tabby_auth_token")
-    sorted_db_path = utils.get_data_dir() / "sorted"
-    out_dir_path = utils.get_data_dir() / "autocompletions"
+    completion_store = open_completion_store(args.storage)
     fetcher = TabbySuggestionsFetcher(
-        TabbyConnection(const.TABBY_URL, tabby_auth_token),
-        sorted_db_path,
-        out_dir_path,
+        open_tabby_connection(
+            args.endpoint or [const.TABBY_URL],
+            os.getenv("tabby_auth_token"),
+            args.stream,
+            None if args.no_cache else args.cache_size_mb,
+            args.cache_tag,
+        ),
+        utils.get_data_dir() / "sorted",
+        completion_store,
         const.SPLIT_RATIO_STEP,
         const.DEFAULT_LANGUAGE,
+        args.concurrency,
     )
     fetcher.run()
+    completion_store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,140 @@
+import random
+import threading
+import time
+
+from typing import Union
+
+CONGESTION_STATUSES = {408, 429, 500, 502, 503, 504}
+# fixed cost of a request expressed in prompt characters,
+# so short prompts are not judged by their per-character latency alone
+REQUEST_OVERHEAD_CHARS = 256
+BASELINE_SMOOTHING = 0.1
+
+
+class AdaptiveRateController:
+    """
+    Congestion-aware limit of requests in flight,
+    tuned live with additive increase / multiplicative decrease
+    driven by response latency and overload responses of the server
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 3.0,
+        smoothing: float = BASELINE_SMOOTHING,
+    ):
+        """
+        Args:
+            max_limit (int): upper bound of requests in flight
+            min_limit (int, optional): lower bound of requests in flight. Defaults to 1.
+            decrease_factor (float, optional): multiplier applied to the limit
+            on congestion. Defaults to 0.5.
+            latency_tolerance (float, optional): latency exceeding the baseline
+            for the prompt's length by this factor is treated as congestion.
+            Defaults to 3.0.
+            smoothing (float, optional): weight of every new measurement
+            in the moving average of latency per prompt character.
+            Defaults to BASELINE_SMOOTHING.
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("Limits have to satisfy 1 <= min_limit <= max_limit")
+        self._max_limit = max_limit
+        self._min_limit = min_limit
+        self._decrease_factor = decrease_factor
+        self._latency_tolerance = latency_tolerance
+        self._smoothing = smoothing
+        self._limit = float(min_limit)
+        self._slow_start_threshold = float(max_limit)
+        self._in_flight = 0
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self.congestion_events = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self):
+        """Block until another request is allowed in flight"""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(
+        self,
+        latency: Union[float, None],
+        status: Union[int, None],
+        prompt_chars: int = 0,
+    ):
+        """Report outcome of a request and adapt the limit
+
+        Args:
+            latency (Union[float, None]): time spent on the request in seconds,
+            None if it was answered without the server, e.g. from the cache
+            status (Union[int, None]): HTTP status of the response,
+            None if no response was received
+            prompt_chars (int, optional): length of the prompt. Defaults to 0.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if latency is not None:
+                if self._is_congested(latency, status, prompt_chars):
+                    self._decrease(latency)
+                elif status is not None and status < 400:
+                    self._increase()
+            self._condition.notify_all()
+
+    def _is_congested(
+        self, latency: float, status: Union[int, None], prompt_chars: int
+    ) -> bool:
+        if status is None or status in CONGESTION_STATUSES:
+            return True
+        if status >= 400:
+            return False
+        latency_per_char = latency / (prompt_chars + REQUEST_OVERHEAD_CHARS)
+        if self._baseline is None:
+            self._baseline = latency_per_char
+            return False
+        congested = latency_per_char > self._baseline * self._latency_tolerance
+        # slow responses only move the baseline once the limit cannot go lower,
+        # then they show the pace of the server rather than our load on it
+        if not congested or self._limit <= self._min_limit:
+            self._baseline += self._smoothing * (latency_per_char - self._baseline)
+        return congested
+
+    def _increase(self):
+        """Grow the limit by one per response in slow start,
+        by one per window of responses afterwards"""
+        if self._limit < self._slow_start_threshold:
+            self._limit += 1
+        else:
+            self._limit += 1 / self._limit
+        self._limit = min(self._limit, float(self._max_limit))
+
+    def _decrease(self, latency: float):
+        """Shrink the limit, at most once per round trip
+        so that one overloaded moment is not punished repeatedly"""
+        now = time.monotonic()
+        if now - self._last_decrease < latency:
+            return
+        self._last_decrease = now
+        self.congestion_events += 1
+        self._limit = max(self._limit * self._decrease_factor, float(self._min_limit))
+        self._slow_start_threshold = self._limit
+
+    def backoff(self, attempt: int, base: float, cap: float) -> float:
+        """
+        Args:
+            attempt (int): number of failed attempts so far
+            base (float): delay after the first failure in seconds
+            cap (float): maximum delay in seconds
+
+        Returns:
+            float: delay before the next attempt with full jitter
+        """
+        return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
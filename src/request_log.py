@@ -0,0 +1,131 @@
+import json
+import threading
+import numpy as np
+
+from pathlib import Path
+from typing import Union
+from dataclasses import dataclass, asdict
+
+PERCENTILES = (50, 90, 99)
+TIMINGS = (
+    "server_latency",
+    "first_byte_latency",
+    "first_token_latency",
+    "queue_wait",
+    "total_time",
+)
+
+
+@dataclass
+class RequestRecord:
+    """Measurements of a single completion request"""
+
+    file: str
+    prefix_ratio: int
+    prefix_length: int
+    completion_length: Union[int, None] = None
+    status: Union[int, None] = None
+    retries: int = 0
+    queue_wait: float = 0.0
+    server_latency: Union[float, None] = None
+    first_byte_latency: Union[float, None] = None
+    first_token_latency: Union[float, None] = None
+    total_time: float = 0.0
+    cached: bool = False
+    endpoint: Union[str, None] = None
+
+    def size_bucket(self) -> str:
+        """
+        Returns:
+            str: power-of-two range of prompt length in characters
+        """
+        upper = 1024
+        while self.prefix_length >= upper:
+            upper *= 2
+        return f"<{upper // 1024}k"
+
+
+class RequestLog:
+    """
+    Structured log of completion requests, written as JSON lines
+    and summarized into latency percentiles at the end of a run
+    """
+
+    def __init__(self, log_path: Path):
+        """
+        Args:
+            log_path (Path): destination of the per-request log, overwritten
+        """
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        self._log_file = open(log_path, "w")
+        self._lock = threading.Lock()
+        self._records: list[RequestRecord] = []
+
+    def add(self, record: RequestRecord):
+        with self._lock:
+            self._records.append(record)
+            self._log_file.write(json.dumps(asdict(record)) + "\n")
+            self._log_file.flush()
+
+    def close(self):
+        self._log_file.close()
+
+    def _percentiles(self, records: list[RequestRecord]) -> dict:
+        """
+        Args:
+            records (list[RequestRecord]): group of requests to summarize
+
+        Returns:
+            dict: request count and percentiles of every timing in seconds
+        """
+        summary = {"count": len(records)}
+        for timing in TIMINGS:
+            values = [
+                getattr(record, timing)
+                for record in records
+                if getattr(record, timing) is not None
+            ]
+            if values:
+                summary[timing] = dict(
+                    zip(
+                        (f"p{p}" for p in PERCENTILES),
+                        np.round(np.percentile(values, PERCENTILES), 4).tolist(),
+                    )
+                )
+        return summary
+
+    def _grouped(self, key, sort_key) -> dict:
+        """
+        Args:
+            key: function naming the group of a record
+            sort_key: function ordering the group names
+
+        Returns:
+            dict: percentiles per group
+        """
+        groups: dict[str, list[RequestRecord]] = {}
+        for record in self._records:
+            groups.setdefault(str(key(record)), []).append(record)
+        return {
+            name: self._percentiles(groups[name])
+            for name in sorted(groups, key=sort_key)
+        }
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: percentiles overall, by prefix ratio and by prompt size bucket,
+            along with the distribution of response statuses
+        """
+        statuses: dict[str, int] = {}
+        for record in self._records:
+            statuses[str(record.status)] = statuses.get(str(record.status), 0) + 1
+        return {
+            "overall": self._percentiles(self._records),
+            "statuses": statuses,
+            "cached": sum(record.cached for record in self._records),
+            "by_prefix_ratio": self._grouped(lambda record: record.prefix_ratio, int),
+            "by_prompt_size": self._grouped(
+                RequestRecord.size_bucket, lambda name: int(name[1:-1])
+            ),
+        }
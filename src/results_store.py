@@ -0,0 +1,222 @@
+import sqlite3
+
+from array import array
+from pathlib import Path
+from typing import Union
+from collections.abc import Iterator
+
+import pandas as pd
+
+import utils
+from manifest import load_duplicates
+
+ORIGINAL_PREFIX_RATIO = 100
+FLUSH_ROWS = 50_000
+
+STATIC_RESULTS = "static_metrics.sqlite"
+SIMILARITY_RESULTS = "similarity.sqlite"
+STATIC_SCOPE = "static"
+FULL_SCOPE = "full"
+FRAGMENT_SCOPE = "fragment"
+
+
+class ResultsStore:
+    """
+    Consolidated scores of a testing stage in a single indexed table
+    with scope, file, prefix ratio, metric and value columns.
+    Rows are collected in column arrays and written in batches,
+    the scores of the reference file itself have ORIGINAL_PREFIX_RATIO.
+    Duplicates left out of the sorted database are stored once,
+    under the file kept in their place, and read back as files of their own
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        flush_rows: int = FLUSH_ROWS,
+        sorted_dir_path: Path = None,
+    ):
+        """
+        Args:
+            db_path (Path): location of the database
+            flush_rows (int, optional): rows collected before writing them.
+            Defaults to FLUSH_ROWS.
+            sorted_dir_path (Path, optional): sorted database whose duplicates
+            share the scores of the files kept. Defaults to no duplicates.
+        """
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._flush_rows = flush_rows
+        self._sorted_dir_path = sorted_dir_path
+        # written by a single thread, not necessarily the one opening the store
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "scope TEXT NOT NULL, file TEXT NOT NULL, prefix_ratio INTEGER NOT NULL, "
+            "metric TEXT NOT NULL, value REAL, "
+            "PRIMARY KEY (scope, file, prefix_ratio, metric))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_metric "
+            "ON results (scope, metric, prefix_ratio)"
+        )
+        self._files: set[tuple[str, str]] = set()
+        self._reset_buffer()
+
+    def _reset_buffer(self):
+        self._scopes: list[str] = []
+        self._file_names: list[str] = []
+        self._prefix_ratios = array("i")
+        self._metrics: list[str] = []
+        # NaN stands for missing scores, stored as NULL
+        self._values = array("d")
+        self._files.clear()
+
+    def add(
+        self,
+        scope: str,
+        relative_path: Path,
+        results: dict[int, dict[str, Union[float, None]]],
+    ):
+        """Collect scores of a reference file and its completions,
+        replacing the file's earlier results
+
+        Args:
+            scope (str): part of the stage the scores belong to, e.g. "full"
+            relative_path (Path): reference file path relative to the sorted database
+            results (dict[int, dict[str, Union[float, None]]]): value of every metric
+            by prefix ratio, ORIGINAL_PREFIX_RATIO for the reference file
+        """
+        file_name = relative_path.as_posix()
+        self._files.add((scope, file_name))
+        for prefix_ratio, scores in results.items():
+            for metric, value in scores.items():
+                self._scopes.append(scope)
+                self._file_names.append(file_name)
+                self._prefix_ratios.append(prefix_ratio)
+                self._metrics.append(metric)
+                self._values.append(float("nan") if value is None else float(value))
+        if len(self._values) >= self._flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the collected rows in a single transaction"""
+        if not self._values:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM results WHERE scope = ? AND file = ?", self._files
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                zip(
+                    self._scopes,
+                    self._file_names,
+                    self._prefix_ratios,
+                    self._metrics,
+                    self._values,
+                ),
+            )
+        self._reset_buffer()
+
+    def duplicates(self) -> dict[str, list[str]]:
+        """
+        Returns:
+            dict[str, list[str]]: duplicates sharing the scores of a file
+            by its relative path, as recorded by the last sorting
+        """
+        if self._sorted_dir_path is None:
+            return {}
+        return load_duplicates(self._sorted_dir_path)
+
+    def load(self, scope: str) -> pd.DataFrame:
+        """
+        Args:
+            scope (str): part of the stage to load
+
+        Returns:
+            pd.DataFrame: scores of all files in one read, duplicates included,
+            indexed by file and prefix ratio, one column per metric
+        """
+        self.flush()
+        long_df = pd.read_sql_query(
+            "SELECT file, prefix_ratio, metric, value FROM results WHERE scope = ?",
+            self._connection,
+            params=(scope,),
+        )
+        copies = pd.DataFrame(
+            [
+                (file, duplicate)
+                for file, duplicates in self.duplicates().items()
+                for duplicate in duplicates
+            ],
+            columns=["file", "duplicate"],
+        )
+        duplicates_df = (
+            long_df.merge(copies, on="file")
+            .drop(columns="file")
+            .rename(columns={"duplicate": "file"})
+        )
+        long_df = pd.concat([long_df, duplicates_df], ignore_index=True)
+        return long_df.pivot(
+            index=["file", "prefix_ratio"], columns="metric", values="value"
+        )
+
+    def file_results(
+        self, scope: str
+    ) -> Iterator[tuple[str, dict[int, dict[str, Union[float, None]]]]]:
+        """
+        Args:
+            scope (str): part of the stage to read
+
+        Yields:
+            Iterator[tuple[str, dict[int, dict[str, Union[float, None]]]]]:
+            relative path of every file, duplicates included,
+            with its scores by prefix ratio, read one row at a time
+        """
+        self.flush()
+        duplicates = self.duplicates()
+        file_name, results = None, {}
+        for row_file, prefix_ratio, metric, value in self._connection.execute(
+            "SELECT file, prefix_ratio, metric, value FROM results "
+            "WHERE scope = ? ORDER BY file",
+            (scope,),
+        ):
+            if row_file != file_name:
+                if file_name is not None:
+                    for name in (file_name, *duplicates.get(file_name, [])):
+                        yield name, results
+                file_name, results = row_file, {}
+            results.setdefault(prefix_ratio, {})[metric] = value
+        if file_name is not None:
+            for name in (file_name, *duplicates.get(file_name, [])):
+                yield name, results
+
+    def remove(self, relative_path: Path):
+        """Drop the scores of a reference file in all scopes
+
+        Args:
+            relative_path (Path): reference file path relative to the sorted database
+        """
+        self.flush()
+        with self._connection:
+            self._connection.execute(
+                "DELETE FROM results WHERE file = ?", (relative_path.as_posix(),)
+            )
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+
+def open_results_store(name: str) -> ResultsStore:
+    """
+    Args:
+        name (str): STATIC_RESULTS or SIMILARITY_RESULTS
+
+    Returns:
+        ResultsStore: store of the stage in the data directory
+    """
+    return ResultsStore(
+        utils.get_data_dir() / name, sorted_dir_path=utils.get_data_dir() / "sorted"
+    )
@@ -0,0 +1,297 @@
+"""
+Aggregates of testing scores updated one value at a time
+and mergeable across workers, runs or corpus shards
+"""
+
+import json
+import math
+
+from pathlib import Path
+from typing import Union
+from collections import Counter
+
+import utils
+from results_store import ResultsStore
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SUMMARY_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+STATIC_SUMMARY = "static_summary.json"
+SIMILARITY_SUMMARY = "similarity_summary.json"
+
+
+class RunningStats:
+    """Count, mean, variance (Welford), minimum and maximum"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "RunningStats"):
+        """Combine with statistics of other values (Chan et al.)"""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self._m2 += other._m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> Union[float, None]:
+        """
+        Returns:
+            Union[float, None]: sample variance, None for fewer than two values
+        """
+        return self._m2 / (self.count - 1) if self.count > 1 else None
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self._m2,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "RunningStats":
+        stats = cls()
+        stats.count, stats.mean, stats._m2 = data["count"], data["mean"], data["m2"]
+        stats.min, stats.max = data["min"], data["max"]
+        return stats
+
+
+class QuantileSketch:
+    """
+    Logarithmically bucketed histogram (DDSketch) answering quantiles
+    within a relative error, merged exactly by adding bucket counts
+    """
+
+    def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY):
+        """
+        Args:
+            relative_accuracy (float, optional): bound of the relative error
+            of returned quantiles. Defaults to SKETCH_RELATIVE_ACCURACY.
+        """
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.positive: Counter = Counter()
+        self.negative: Counter = Counter()
+        self.zeros = 0
+        self.count = 0
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> float:
+        return 2 * self._gamma**key / (self._gamma + 1)
+
+    def add(self, value: float):
+        self.count += 1
+        if value > 0:
+            self.positive[self._key(value)] += 1
+        elif value < 0:
+            self.negative[self._key(-value)] += 1
+        else:
+            self.zeros += 1
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches of different accuracy")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q: float) -> Union[float, None]:
+        """
+        Args:
+            q (float): quantile in [0, 1]
+
+        Returns:
+            Union[float, None]: estimate of the quantile, None without values
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": self.positive,
+            "negative": self.negative,
+            "zeros": self.zeros,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        sketch = cls(data["relative_accuracy"])
+        for sign in ("positive", "negative"):
+            getattr(sketch, sign).update(
+                {int(key): count for key, count in data[sign].items()}
+            )
+        sketch.zeros = data["zeros"]
+        sketch.count = (
+            sum(sketch.positive.values()) + sum(sketch.negative.values()) + sketch.zeros
+        )
+        return sketch
+
+
+class ResultsSummary:
+    """
+    Running statistics and quantile sketches of every metric
+    per scope and prefix ratio, kept while a testing stage runs
+    """
+
+    def __init__(self):
+        self._aggregates: dict[
+            tuple[str, str, int], tuple[RunningStats, QuantileSketch]
+        ] = {}
+
+    def add(
+        self,
+        scope: str,
+        results: dict[int, dict[str, Union[float, None]]],
+        copies: int = 1,
+    ):
+        """
+        Args:
+            scope (str): part of the stage the scores belong to, e.g. "full"
+            results (dict[int, dict[str, Union[float, None]]]): scores of a file
+            by prefix ratio, missing scores are skipped
+            copies (int, optional): number of dataset files sharing the scores,
+            the file and its duplicates. Defaults to 1.
+        """
+        for prefix_ratio, scores in results.items():
+            for metric, value in scores.items():
+                if value is None or math.isnan(value):
+                    continue
+                stats, sketch = self._aggregate(scope, metric, prefix_ratio)
+                for _ in range(copies):
+                    stats.add(float(value))
+                    sketch.add(float(value))
+
+    def _aggregate(
+        self, scope: str, metric: str, prefix_ratio: int
+    ) -> tuple[RunningStats, QuantileSketch]:
+        key = (scope, metric, prefix_ratio)
+        if key not in self._aggregates:
+            self._aggregates[key] = (RunningStats(), QuantileSketch())
+        return self._aggregates[key]
+
+    def merge(self, other: "ResultsSummary"):
+        """Add aggregates of another worker, run or corpus shard"""
+        for key, (other_stats, other_sketch) in other._aggregates.items():
+            stats, sketch = self._aggregate(*key)
+            stats.merge(other_stats)
+            sketch.merge(other_sketch)
+
+    def headline(self) -> list[dict]:
+        """
+        Returns:
+            list[dict]: count, mean, standard deviation, extremes and quantiles
+            per scope, metric and prefix ratio
+        """
+        rows = []
+        for (scope, metric, prefix_ratio), (stats, sketch) in sorted(
+            self._aggregates.items()
+        ):
+            variance = stats.variance
+            rows.append(
+                {
+                    "scope": scope,
+                    "metric": metric,
+                    "prefix_ratio": prefix_ratio,
+                    "count": stats.count,
+                    "mean": stats.mean,
+                    "std": math.sqrt(variance) if variance is not None else None,
+                    "min": stats.min,
+                    "max": stats.max,
+                    **{f"q{q:g}": sketch.quantile(q) for q in SUMMARY_QUANTILES},
+                }
+            )
+        return rows
+
+    @classmethod
+    def from_store(
+        cls, results_store: ResultsStore, scopes: list[str]
+    ) -> "ResultsSummary":
+        """Rebuild the aggregates of all stored scores,
+        e.g. after only some of the files were evaluated again
+
+        Args:
+            results_store (ResultsStore): consolidated store of a testing stage
+            scopes (list[str]): parts of the stage to aggregate
+
+        Returns:
+            ResultsSummary: aggregates of every stored file
+        """
+        summary = cls()
+        for scope in scopes:
+            for _, results in results_store.file_results(scope):
+                summary.add(scope, results)
+        return summary
+
+    def save(self, fpath: Path):
+        """Write headline numbers together with the mergeable state"""
+        utils.write_to_file(
+            fpath,
+            json.dumps(
+                {
+                    "headline": self.headline(),
+                    "aggregates": [
+                        {
+                            "scope": scope,
+                            "metric": metric,
+                            "prefix_ratio": prefix_ratio,
+                            "stats": stats.to_dict(),
+                            "sketch": sketch.to_dict(),
+                        }
+                        for (scope, metric, prefix_ratio), (
+                            stats,
+                            sketch,
+                        ) in self._aggregates.items()
+                    ],
+                },
+                indent=1,
+            ),
+        )
+
+    @classmethod
+    def load(cls, fpath: Path) -> "ResultsSummary":
+        summary = cls()
+        for entry in json.loads(utils.load_file(fpath))["aggregates"]:
+            summary._aggregates[
+                (entry["scope"], entry["metric"], entry["prefix_ratio"])
+            ] = (
+                RunningStats.from_dict(entry["stats"]),
+                QuantileSketch.from_dict(entry["sketch"]),
+            )
+        return summary
@@ -0,0 +1,91 @@
+"""
+Registry of the similarity algorithms shared by similarity testing and plotting
+"""
+
+from difflib import SequenceMatcher
+from dataclasses import dataclass
+from collections.abc import Callable
+
+from jellyfish import (
+    damerau_levenshtein_distance,
+    hamming_distance,
+    jaro_winkler_similarity,
+)
+
+from similarity_engine import (
+    BoundedScore,
+    bounded_damerau_levenshtein,
+    bounded_sequence_matcher_ratio,
+    prefix_aware_damerau_levenshtein,
+    prefix_aware_hamming,
+    sequence_matcher_ratio,
+)
+
+SEQUENCE_MATCHER = SequenceMatcher.__name__
+DAMERAU_LEVENSHTEIN = damerau_levenshtein_distance.__name__
+HAMMING = hamming_distance.__name__
+JARO_WINKLER = jaro_winkler_similarity.__name__
+
+
+@dataclass(frozen=True)
+class SimilarityAlgorithm:
+    """Similarity algorithm together with its presentation"""
+
+    name: str
+    compare: Callable[[str, str], float]
+    plot_color: str
+    # variant deciding only whether the score passes a bound, see similarity_engine
+    bounded: Callable[[str, str, float], BoundedScore] = None
+
+
+SIMILARITY_ALGORITHMS: dict[str, SimilarityAlgorithm] = {}
+
+
+def register(algorithm: SimilarityAlgorithm):
+    """
+    Args:
+        algorithm (SimilarityAlgorithm): algorithm to make available
+        to the similarity tester and plots under its name
+    """
+    SIMILARITY_ALGORITHMS[algorithm.name] = algorithm
+
+
+register(
+    SimilarityAlgorithm(
+        SEQUENCE_MATCHER,
+        sequence_matcher_ratio,
+        "brown",
+        bounded_sequence_matcher_ratio,
+    )
+)
+register(
+    SimilarityAlgorithm(
+        DAMERAU_LEVENSHTEIN,
+        prefix_aware_damerau_levenshtein,
+        "green",
+        bounded_damerau_levenshtein,
+    )
+)
+register(SimilarityAlgorithm(HAMMING, prefix_aware_hamming, "purple"))
+register(SimilarityAlgorithm(JARO_WINKLER, jaro_winkler_similarity, "blue"))
+
+
+def select_algorithms(names: list[str] = None) -> dict[str, SimilarityAlgorithm]:
+    """
+    Args:
+        names (list[str], optional): algorithms to run, all registered
+        ones if not given. Defaults to None.
+
+    Returns:
+        dict[str, SimilarityAlgorithm]: selected algorithms in registration order
+    """
+    if not names:
+        return dict(SIMILARITY_ALGORITHMS)
+    unknown = set(names) - set(SIMILARITY_ALGORITHMS)
+    if unknown:
+        raise ValueError(f"Unknown similarity algorithms: {', '.join(sorted(unknown))}")
+    return {
+        name: algorithm
+        for name, algorithm in SIMILARITY_ALGORITHMS.items()
+        if name in names
+    }
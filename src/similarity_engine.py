@@ -0,0 +1,276 @@
+"""
+Similarity of a reference program and its Tabby completed replica,
+which by construction share the prefix used as the prompt.
+
+Damerau-Levenshtein and Hamming distances only run on the differing
+middle of the pair, after the common prefix (and for Damerau-Levenshtein
+the common suffix) is stripped, and give exactly the full-string result.
+SequenceMatcher.ratio and Jaro-Winkler similarity are not decomposable
+this way: SequenceMatcher's junk heuristic and longest-block search and
+Jaro's match window depend on the whole strings, so both stay full-string.
+"""
+
+from typing import NamedTuple, Union
+from difflib import SequenceMatcher
+
+import numpy as np
+from jellyfish import damerau_levenshtein_distance, hamming_distance
+
+PREFIX_SCAN_CHUNK = 4096
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    """
+    Args:
+        a (str): first string
+        b (str): second string
+
+    Returns:
+        int: length of the longest common prefix,
+        compared chunk by chunk with a binary search in the first differing chunk
+    """
+    limit = min(len(a), len(b))
+    start = 0
+    while start < limit:
+        end = min(start + PREFIX_SCAN_CHUNK, limit)
+        if a[start:end] != b[start:end]:
+            break
+        start = end
+    else:
+        return limit
+    low, high = start, end
+    while high - low > 1:
+        middle = (low + high) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def common_suffix_length(a: str, b: str, limit: int) -> int:
+    """
+    Args:
+        a (str): first string
+        b (str): second string
+        limit (int): maximum length, keeping the suffix clear of a stripped prefix
+
+    Returns:
+        int: length of the longest common suffix, at most limit
+    """
+    length = 0
+    while length < limit and a[-length - 1] == b[-length - 1]:
+        length += 1
+    return length
+
+
+def prefix_aware_damerau_levenshtein(og: str, replica: str) -> int:
+    """
+    Args:
+        og (str): reference program or its fragment
+        replica (str): Tabby completed program or the generated fragment
+
+    Returns:
+        int: Damerau-Levenshtein distance, computed on the strings
+        stripped of their common prefix and suffix, which do not change it
+    """
+    prefix = common_prefix_length(og, replica)
+    suffix = common_suffix_length(og, replica, min(len(og), len(replica)) - prefix)
+    return damerau_levenshtein_distance(
+        og[prefix : len(og) - suffix], replica[prefix : len(replica) - suffix]
+    )
+
+
+def prefix_aware_hamming(og: str, replica: str) -> int:
+    """
+    Args:
+        og (str): reference program or its fragment
+        replica (str): Tabby completed program or the generated fragment
+
+    Returns:
+        int: Hamming distance, computed on the strings stripped of their
+        common prefix; positions past the prefix stay aligned
+    """
+    prefix = common_prefix_length(og, replica)
+    return hamming_distance(og[prefix:], replica[prefix:])
+
+
+def sequence_matcher_ratio(og: str, replica: str) -> float:
+    """
+    Args:
+        og (str): reference program or its fragment
+        replica (str): Tabby completed program or the generated fragment
+
+    Returns:
+        float: difflib.SequenceMatcher ratio over the full strings
+    """
+    return SequenceMatcher(None, a=og, b=replica).ratio()
+
+
+class BoundedScore(NamedTuple):
+    """Score of a bounded similarity algorithm:
+    the exact value, or the bound it is known to exceed when censored"""
+
+    value: float
+    censored: bool
+
+
+def _symbol_ids(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Returns:
+        tuple[np.ndarray, np.ndarray, int]: both sequences renumbered
+        to dense symbol ids and the number of distinct symbols
+    """
+    symbols, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+    return inverse[: len(a)], inverse[len(a) :], len(symbols)
+
+
+def damerau_levenshtein_array(
+    a: np.ndarray, b: np.ndarray, max_distance: int = None
+) -> Union[int, None]:
+    """Unrestricted Damerau-Levenshtein distance (Lowrance-Wagner, as in jellyfish)
+    of two integer sequences, computed row by row with numpy.
+
+    With max_distance only the diagonal band of that width is kept:
+    a path leaving the band already costs more than max_distance,
+    and the computation stops as soon as a whole row exceeds it.
+
+    Args:
+        a (np.ndarray): first sequence of integer symbols
+        b (np.ndarray): second sequence of integer symbols
+        max_distance (int, optional): largest distance of interest. Defaults to None.
+
+    Returns:
+        Union[int, None]: the distance, or None if it exceeds max_distance
+    """
+    n, m = len(a), len(b)
+    band = max(n, m) if max_distance is None else max_distance
+    if abs(n - m) > band:
+        return None
+    if n == 0 or m == 0:
+        return max(n, m)
+    a_ids, b_ids, symbol_count = _symbol_ids(a, b)
+    inf = n + m + 1
+    width = min(2 * band + 1, m + 1)
+    offsets = np.clip(np.arange(n + 1) - band, 0, m + 1 - width)
+    rows = np.full((n + 1, width), inf, dtype=np.int32)
+    rows[0] = np.arange(width)
+
+    def cells(row_idx: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        rel = cols - offsets[row_idx]
+        valid = (rel >= 0) & (rel < width) & (row_idx >= 0)
+        values = rows[np.maximum(row_idx, 0), np.clip(rel, 0, width - 1)]
+        return np.where(valid, values, inf)
+
+    # positions of every symbol in b, to find the last match left of the band
+    b_order = np.argsort(b_ids, kind="stable")
+    b_starts = np.searchsorted(b_ids[b_order], np.arange(symbol_count + 1))
+    last_row = np.zeros(symbol_count, dtype=np.int64)
+    for i in range(1, n + 1):
+        symbol = a_ids[i - 1]
+        cols = np.arange(offsets[i], offsets[i] + width)
+        b_symbols = b_ids[np.maximum(cols - 1, 0)]
+        eq = (b_symbols == symbol) & (cols >= 1)
+        prev_row = np.full(width, i - 1)
+        diag = cells(prev_row, cols - 1) + ~eq
+        up = cells(prev_row, cols) + 1
+
+        matches = b_order[b_starts[symbol] : b_starts[symbol + 1]] + 1
+        before = matches[: np.searchsorted(matches, offsets[i])]
+        last_col = np.maximum.accumulate(
+            np.concatenate(
+                ([before[-1] if len(before) else 0], np.where(eq, cols, 0)[:-1])
+            )
+        )
+        last_match_row = last_row[b_symbols]
+        transposition = (
+            cells(last_match_row - 1, last_col - 1)
+            + (i - last_match_row - 1)
+            + 1
+            + (cols - last_col - 1)
+        )
+        transposition[(last_match_row < 1) | (last_col < 1) | (cols < 1)] = inf
+
+        candidates = np.minimum(np.minimum(diag, up), transposition)
+        candidates[cols == 0] = i
+        row = np.minimum.accumulate(candidates - cols) + cols
+        rows[i] = np.minimum(row, inf)
+        last_row[symbol] = i
+        if max_distance is not None and rows[i].min() > band:
+            return None
+    distance = int(cells(np.array([n]), np.array([m]))[0])
+    return distance if distance <= band else None
+
+
+def code_points(text: str) -> np.ndarray:
+    """
+    Args:
+        text (str): string to convert
+
+    Returns:
+        np.ndarray: unicode code points of the string
+    """
+    return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+
+
+def histogram_lower_bound(a: np.ndarray, b: np.ndarray) -> int:
+    """Damerau-Levenshtein lower bound from symbol counts:
+    every edit removes at most one surplus symbol of each sequence
+    and transpositions keep the counts
+
+    Args:
+        a (np.ndarray): first sequence of integer symbols
+        b (np.ndarray): second sequence of integer symbols
+
+    Returns:
+        int: larger of the two sequences' surplus symbol counts
+    """
+    a_ids, b_ids, symbol_count = _symbol_ids(a, b)
+    surplus = np.bincount(a_ids, minlength=symbol_count) - np.bincount(
+        b_ids, minlength=symbol_count
+    )
+    return int(max(surplus[surplus > 0].sum(), -surplus[surplus < 0].sum()))
+
+
+def bounded_damerau_levenshtein(og: str, replica: str, bound: int) -> BoundedScore:
+    """
+    Args:
+        og (str): reference program or its fragment
+        replica (str): Tabby completed program or the generated fragment
+        bound (int): cutoff, distances from this value up are not computed exactly
+
+    Returns:
+        BoundedScore: exact distance below the cutoff, otherwise the cutoff,
+        censored; decided by length and symbol count bounds where possible,
+        else by the banded computation on the pair stripped of its common
+        prefix and suffix
+    """
+    prefix = common_prefix_length(og, replica)
+    suffix = common_suffix_length(og, replica, min(len(og), len(replica)) - prefix)
+    a = code_points(og[prefix : len(og) - suffix])
+    b = code_points(replica[prefix : len(replica) - suffix])
+    if abs(len(a) - len(b)) >= bound or histogram_lower_bound(a, b) >= bound:
+        return BoundedScore(bound, True)
+    distance = damerau_levenshtein_array(a, b, bound - 1)
+    if distance is None:
+        return BoundedScore(bound, True)
+    return BoundedScore(distance, False)
+
+
+def bounded_sequence_matcher_ratio(og: str, replica: str, bound: float) -> BoundedScore:
+    """
+    Args:
+        og (str): reference program or its fragment
+        replica (str): Tabby completed program or the generated fragment
+        bound (float): minimum ratio, lower ratios are not computed exactly
+
+    Returns:
+        BoundedScore: exact ratio, or its real_quick_ratio/quick_ratio
+        upper bound, censored, when the upper bound is already below the minimum
+    """
+    matcher = SequenceMatcher(None, a=og, b=replica)
+    for upper_bound in (matcher.real_quick_ratio, matcher.quick_ratio):
+        ratio = upper_bound()
+        if ratio < bound:
+            return BoundedScore(ratio, True)
+    return BoundedScore(matcher.ratio(), False)
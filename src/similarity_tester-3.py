@@ -1,16 +1,38 @@
 import os
-import pandas as pd
+import json
+import time
+import argparse
 from tqdm import tqdm
 from pathlib import Path
-from difflib import SequenceMatcher
-from collections.abc import Generator
-from jellyfish import (
-    damerau_levenshtein_distance,
-    hamming_distance,
-    jaro_winkler_similarity,
-)
+from typing import Union
+from functools import partial
+from collections import Counter
+from collections.abc import Iterable, Sized
+import const
 import utils
-from prefix_generator import PrefixGenerator
+from similarity_algorithms import (
+    DAMERAU_LEVENSHTEIN,
+    SEQUENCE_MATCHER,
+    SIMILARITY_ALGORITHMS,
+    select_algorithms,
+)
+from manifest import load_manifest
+from completion_store import (
+    CompletionStore,
+    FileCompletionStore,
+    STORAGE_KINDS,
+    open_completion_store,
+)
+from metric_cache import MetricCache, open_metric_cache
+from running_stats import SIMILARITY_SUMMARY, ResultsSummary
+from token_sequences import TokenEncoder, token_slice
+from results_store import (
+    FRAGMENT_SCOPE,
+    FULL_SCOPE,
+    SIMILARITY_RESULTS,
+    ResultsStore,
+    open_results_store,
+)
 
 
 class SimilarityTester:
@@ -18,178 +40,412 @@ class SimilarityTester:
     and original snippets using predefined algorithms.
     """
 
-    def __init__(self, fragment_out_dir_path: Path, full_out_dir_path: Path):
+    def __init__(
+        self,
+        results_store: ResultsStore,
+        completion_store: CompletionStore,
+        metric_cache: MetricCache = None,
+        workers: int = 1,
+        max_distance: int = None,
+        min_ratio: float = None,
+        tokens: bool = False,
+        algorithm_names: list[str] = None,
+    ):
         """
         Args:
-            fragment_out_dir_path (Path): path to the directory
-            to save similarity scores for overlap with generated fragments
+            results_store (ResultsStore): consolidated store of the similarity
+            scores for full files and for overlap with generated fragments
+
+            completion_store (CompletionStore): source of Tabby autocompletions
+
+            metric_cache (MetricCache, optional): scores of pairs
+            compared in earlier runs. Defaults to None.
 
-            full_out_dir_path (Path): path to the directory
-            to save similarity scores for full files
+            workers (int, optional): number of processes comparing files,
+            each file with all its completions is a single work unit. Defaults to 1.
+
+            max_distance (int, optional): cutoff of the bounded Damerau-Levenshtein
+            distance, larger distances are recorded as censored. Defaults to None.
+
+            min_ratio (float, optional): SequenceMatcher ratios whose upper bounds
+            fall below it are recorded as censored. Defaults to None.
+
+            tokens (bool, optional): compare sequences of Python tokens
+            instead of characters. Defaults to False.
+
+            algorithm_names (list[str], optional): similarity algorithms to run,
+            all registered ones if not given. Defaults to None.
         """
-        self._fragment_out_path = fragment_out_dir_path
-        self._full_out_path = full_out_dir_path
-        self.SIMILARITY_ALGORITHMS = {
-            SequenceMatcher.__name__: lambda og, replica: SequenceMatcher(
-                None, a=og, b=replica
-            ).ratio(),
-            damerau_levenshtein_distance.__name__: lambda og, replica: damerau_levenshtein_distance(
-                og, replica
-            ),
-            hamming_distance.__name__: lambda og, replica: hamming_distance(
-                og, replica
-            ),
-            jaro_winkler_similarity.__name__: lambda og, replica: jaro_winkler_similarity(
-                og, replica
-            ),
+        self._results_store = results_store
+        self._completion_store = completion_store
+        self._metric_cache = metric_cache
+        self._workers = workers
+        self._sorted_dir_path = utils.get_data_dir() / "sorted"
+        self._algorithms = {
+            algorithm_name: algorithm.compare
+            for algorithm_name, algorithm in select_algorithms(algorithm_names).items()
         }
-        self._reset_dataframes()
-
-    def _reset_dataframes(self):
-        """clear contents of the dataframes, keeping the column indexes"""
-        self._fragment_df = None
-        self._full_df = None
-        cols = list(self.SIMILARITY_ALGORITHMS.keys())
-        self._fragment_df = pd.DataFrame(columns=cols)
-        cols.append("original_duplicate_len_ratio")
-        self._full_df = pd.DataFrame(columns=cols)
-
-    def _total_file_count(self) -> int:
+        self._cache_variant = ""
+        self._bounded_algorithms = []
+        for algorithm_name, bound, variant in (
+            (DAMERAU_LEVENSHTEIN, max_distance, "max-distance"),
+            (SEQUENCE_MATCHER, min_ratio, "min-ratio"),
+        ):
+            if bound is None or algorithm_name not in self._algorithms:
+                continue
+            self._algorithms[algorithm_name] = partial(
+                SIMILARITY_ALGORITHMS[algorithm_name].bounded, bound=bound
+            )
+            self._bounded_algorithms.append(algorithm_name)
+            self._cache_variant += f"/{variant}-{bound}"
+        self._tokens = tokens
+        if tokens:
+            self._cache_variant += "/tokens"
+        self._algorithm_seconds = Counter()
+        self._reported_cache_counters = (0, 0)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # results are written by the main process only
+        state["_results_store"] = None
+        return state
+
+    @property
+    def settings(self) -> str:
         """
         Returns:
-            int: total number of files in input directory
+            str: selected algorithms and options changing their scores
         """
-        sorted_dir = utils.get_data_dir() / "sorted"
-        total = 0
-        for root, dirs, files in os.walk(sorted_dir):
-            total += len(files)
-        return total
+        return ",".join(self._algorithms) + self._cache_variant
 
-    def _next_reference_filepath(self) -> Generator[Path]:
-        """
-        Yields:
-            Generator[Path]: paths to files in the input directory
-        """
-        sorted_dir = utils.get_data_dir() / "sorted"
-        for fpath in sorted_dir.rglob("*"):
-            if fpath.is_file():
-                yield fpath
+    def run(self, paths: Iterable[Path] = None) -> list[Path]:
+        """Runs the similarity testing cycle for all files,
+        results are written by this process only, in manifest order
+
+        Args:
+            paths (Iterable[Path], optional): reference files to compare again,
+            keeping the stored results of all others, possibly streamed
+            while their completions are fetched. Defaults to all files.
 
-    def _next_completed_by_prefix(self, og_fpath: Path) -> Generator[tuple[int, Path]]:
+        Returns:
+            list[Path]: reference files that could not be compared
         """
-        Iterates through prefix-ratio directories in autocompleted directory,
-        in each searching for the corresponding reference file path.
+        if paths is None:
+            paths = list(load_manifest(self._sorted_dir_path).paths())
+            summary = ResultsSummary()
+            # duplicates left out by the sorting count with the file kept
+            duplicates = self._results_store.duplicates()
+        else:
+            # aggregates are rebuilt from the store, covering the files kept
+            summary = None
+        if isinstance(self._completion_store, FileCompletionStore):
+            if isinstance(paths, Sized):
+                # walk the autocompletions once here instead of once per worker
+                self._completion_store.build_index()
+            else:
+                # streamed files are looked up as their completions arrive
+                self._completion_store.clear_index()
+        failed, cache_hits, cache_misses = [], 0, 0
+        algorithm_seconds = Counter()
+        results = utils.parallel_map(
+            _compare_in_worker,
+            paths,
+            self._workers,
+            initializer=_init_worker,
+            initargs=(self,),
+        )
+        progress = tqdm(
+            results,
+            desc="Similarity testing",
+            total=len(paths) if isinstance(paths, Sized) else None,
+        )
+        for og_fpath, results, usage, error in progress:
+            cache_hits += usage["cache_hits"]
+            cache_misses += usage["cache_misses"]
+            algorithm_seconds.update(usage["algorithm_seconds"])
+            if error is not None:
+                failed.append(og_fpath)
+                tqdm.write(f"{og_fpath.relative_to(self._sorted_dir_path)}: {error}")
+                continue
+            relative_path = og_fpath.relative_to(self._sorted_dir_path)
+            fragment_results, full_results = results
+            self._results_store.add(FRAGMENT_SCOPE, relative_path, fragment_results)
+            self._results_store.add(FULL_SCOPE, relative_path, full_results)
+            if summary is not None:
+                copies = 1 + len(duplicates.get(relative_path.as_posix(), []))
+                summary.add(FRAGMENT_SCOPE, fragment_results, copies)
+                summary.add(FULL_SCOPE, full_results, copies)
+        self._results_store.flush()
+        if summary is None:
+            summary = ResultsSummary.from_store(
+                self._results_store, [FRAGMENT_SCOPE, FULL_SCOPE]
+            )
+        summary.save(utils.get_data_dir() / SIMILARITY_SUMMARY)
+        tqdm.write(f"Similarity testing done, {len(failed)} files failed")
+        self._save_algorithm_seconds(algorithm_seconds)
+        if self._metric_cache is not None:
+            lookups = cache_hits + cache_misses
+            tqdm.write(
+                f"Metric cache: {cache_hits} hits, {cache_misses} misses, "
+                f"hit rate {cache_hits / lookups if lookups else 0.0:.4f}"
+            )
+        return failed
+
+    def compare_file(
+        self, og_fpath: Path
+    ) -> tuple[dict[int, dict[str, float]], dict[int, dict[str, float]]]:
+        """Compare the reference file with all of its autocompletions
+
         Args:
             og_fpath (Path): reference file path
 
-        Yields:
-            Generator[tuple[int, Path]]: prefix_ratio of the prompt
-            and path to file generated with this prompt
+        Returns:
+            tuple[dict[int, dict[str, float]], dict[int, dict[str, float]]]:
+            fragment and full file scores by prefix ratio
         """
-        autocompletions_dir = utils.get_data_dir() / "autocompletions"
-        og_relative_path = og_fpath.relative_to(utils.get_data_dir() / "sorted")
-        for dir_ in autocompletions_dir.iterdir():
-            prefix_ratio = dir_.name.split("-")[-1]
-            for fpath in dir_.rglob("*"):
-                if fpath.is_file():
-                    relative_path = fpath.relative_to(dir_)
-                    if relative_path == og_relative_path:
-                        yield int(prefix_ratio), fpath
-
-    def run(self):
-        """Runs the similarity testing cycle for all files"""
-        for og_fpath in tqdm(
-            self._next_reference_filepath(),
-            desc="Similarity testing",
-            total=self._total_file_count(),
-            leave=False,
+        fragment_results, full_results = {}, {}
+        og_full = utils.load_file(og_fpath)
+        token_encoder = None
+        if self._tokens:
+            # ids only have to agree within the file, a fresh encoder
+            # keeps the interned tokens from growing with the corpus
+            token_encoder = TokenEncoder()
+            # tokenized once, shared by all prefix ratios
+            og_tokens, og_offsets = token_encoder.encode(og_full)
+        for prefix_ratio, replica_full in self._completion_store.next_completion(
+            og_fpath.relative_to(self._sorted_dir_path), og_full
         ):
-            og_full = utils.load_file(og_fpath)
-            for prefix_ratio, fpath in tqdm(
-                self._next_completed_by_prefix(og_fpath),
-                desc=f"{og_fpath.parent.name}/{og_fpath.name}",
-                total=9,
-                leave=False,
-            ):
-                replica_full = utils.load_file(fpath)
-
-                split_idx = round(len(og_full) * prefix_ratio / 100)
-                replica_part = replica_full[split_idx:]
-                end_idx = min(
-                    (split_idx + len(replica_part)),
-                    (split_idx + len(og_full[split_idx:])),
+            split_idx = round(len(og_full) * prefix_ratio / 100)
+            replica_part = replica_full[split_idx:]
+            end_idx = min(
+                (split_idx + len(replica_part)),
+                (split_idx + len(og_full[split_idx:])),
+            )
+            og_part = og_full[split_idx:end_idx]
+
+            if token_encoder is not None:
+                replica_tokens, replica_offsets = token_encoder.encode(replica_full)
+                og_part = token_slice(og_tokens, og_offsets, split_idx, end_idx)
+                replica_part = token_slice(replica_tokens, replica_offsets, split_idx)
+                fragment_results[prefix_ratio] = self._compare(
+                    og_part, replica_part, token_encoder
                 )
-                og_part = og_full[split_idx:end_idx]
-
-                self._run_similarity_algorithms_per_prefix_ratio(
-                    og_full,
-                    replica_full,
-                    og_part,
-                    replica_part,
-                    prefix_ratio,
-                    len(replica_full) / len(og_full),
+                full_similarity_scores = self._compare(
+                    og_tokens, replica_tokens, token_encoder
                 )
-            self._save_results(og_fpath)
-            self._reset_dataframes()
+            else:
+                fragment_results[prefix_ratio] = self._compare(og_part, replica_part)
+                full_similarity_scores = self._compare(og_full, replica_full)
+            full_similarity_scores["original_duplicate_len_ratio"] = len(
+                replica_full
+            ) / len(og_full)
+            full_results[prefix_ratio] = full_similarity_scores
+        return fragment_results, full_results
 
-    def _run_similarity_algorithms_per_prefix_ratio(
-        self,
-        og_full: str,
-        replica_full: str,
-        og_part: str,
-        replica_part: str,
-        prefix_ratio: int,
-        len_ratio: float,
-    ):
+    def _compare(
+        self, og: str, replica: str, token_encoder: TokenEncoder = None
+    ) -> dict[str, float]:
         """
-        Run similarity algorithms both for whole programs and for generated fragments only.
         Args:
-            og_full (str): full content of reference program
-            replica_full (str): full content of duplicate program per prefix ratio
-            og_part (str): part of reference program overlapping with generated part
-            replica_part (str): Tabby generated part
-            prefix_ratio (int): ratio used to create prefix from reference program
-            len_ratio (float): length ratio of Tabby-completed program to ther reference one
+            og (str): reference program or its fragment,
+            as characters or encoded tokens
+            replica (str): Tabby completed program or the generated fragment,
+            as characters or encoded tokens
+            token_encoder (TokenEncoder, optional): encoder of the tokens.
+            Defaults to None, comparing characters.
+
+        Returns:
+            dict[str, float]: score of every similarity algorithm,
+            from the metric cache if available, and whether each bounded score
+            is censored
         """
-        fragment_similarity_scores = {}
-        full_similarity_scores = {}
-        for algorithm_name, algorithm in self.SIMILARITY_ALGORITHMS.items():
-            fragment_result = algorithm(og_part, replica_part)
-            full_result = algorithm(og_full, replica_full)
-            fragment_similarity_scores[algorithm_name] = fragment_result
-            full_similarity_scores[algorithm_name] = full_result
-        full_similarity_scores["original_duplicate_len_ratio"] = len_ratio
-        self._fragment_df.loc[prefix_ratio] = fragment_similarity_scores
-        self._full_df.loc[prefix_ratio] = full_similarity_scores
-
-    def _save_results(self, og_fpath: Path):
+        if self._metric_cache is None:
+            scores = self._run_algorithms(list(self._algorithms), og, replica)
+        else:
+            key_contents = None
+            if token_encoder is not None:
+                # token ids depend on the interning order of the file's encoder
+                key_contents = tuple(
+                    "\0".join(token_encoder.decode(tokens)) for tokens in (og, replica)
+                )
+            scores = self._metric_cache.similarity(
+                og,
+                replica,
+                list(self._algorithms),
+                lambda algorithm_names: self._run_algorithms(
+                    algorithm_names, og, replica
+                ),
+                self._cache_variant,
+                key_contents,
+            )
+        for algorithm_name in self._bounded_algorithms:
+            value, censored = scores[algorithm_name]
+            scores[algorithm_name] = value
+            scores[f"{algorithm_name}_censored"] = bool(censored)
+        return scores
+
+    def _run_algorithms(
+        self, algorithm_names: list[str], og: str, replica: str
+    ) -> dict[str, float]:
         """
-        Creates paths to save testing results, by recreating
-         the relative structure of reference files from the source directory.
         Args:
-            og_fpath (Path): reference file path
+            algorithm_names (list[str]): algorithms to score the pair with
+            og (str): reference program or its fragment
+            replica (str): Tabby completed program or the generated fragment
+
+        Returns:
+            dict[str, float]: score of every given algorithm,
+            adding the time spent to the algorithm's total
         """
-        fragment_fpath = (
-            self._fragment_out_path
-            / og_fpath.relative_to(utils.get_data_dir() / "sorted").parent
-            / f"{og_fpath.name.split('.')[0]}.csv"
+        scores = {}
+        for algorithm_name in algorithm_names:
+            start = time.perf_counter()
+            scores[algorithm_name] = self._algorithms[algorithm_name](og, replica)
+            self._algorithm_seconds[algorithm_name] += time.perf_counter() - start
+        return scores
+
+    def take_usage(self) -> dict:
+        """
+        Returns:
+            dict: metric cache hits and misses and seconds spent
+            per algorithm in this process since the previous call
+        """
+        counters = (
+            (self._metric_cache.hits, self._metric_cache.misses)
+            if self._metric_cache is not None
+            else (0, 0)
         )
-        full_fpath = (
-            self._full_out_path
-            / og_fpath.relative_to(utils.get_data_dir() / "sorted").parent
-            / f"{og_fpath.name.split('.')[0]}.csv"
+        hits, misses = (
+            new - old for new, old in zip(counters, self._reported_cache_counters)
         )
-        fragment_fpath.parent.mkdir(parents=True, exist_ok=True)
-        full_fpath.parent.mkdir(parents=True, exist_ok=True)
-        self._fragment_df.to_csv(fragment_fpath, float_format="%.4f")
-        self._full_df.to_csv(full_fpath, float_format="%.4f")
+        usage = {
+            "cache_hits": hits,
+            "cache_misses": misses,
+            "algorithm_seconds": self._algorithm_seconds,
+        }
+        self._reported_cache_counters = counters
+        self._algorithm_seconds = Counter()
+        return usage
+
+    def _save_algorithm_seconds(self, algorithm_seconds: Counter):
+        """Print cumulative wall time per algorithm, most expensive first,
+        and record it next to the full file logs
+
+        Args:
+            algorithm_seconds (Counter): seconds spent per algorithm
+        """
+        tqdm.write("Time spent per algorithm:")
+        for algorithm_name, seconds in algorithm_seconds.most_common():
+            tqdm.write(f"{algorithm_name:>30} {seconds:10.2f} s")
+        utils.write_to_file(
+            utils.get_data_dir() / "similarity_algorithm_seconds.json",
+            json.dumps(dict(algorithm_seconds.most_common()), indent=1),
+        )
+
+
+_worker_tester: SimilarityTester = None
+
+
+def _init_worker(tester: SimilarityTester):
+    global _worker_tester
+    _worker_tester = tester
+
+
+def _compare_in_worker(
+    og_fpath: Path,
+) -> tuple[
+    Path,
+    Union[tuple[dict, dict], None],
+    dict,
+    Union[str, None],
+]:
+    """
+    Args:
+        og_fpath (Path): reference file path
+
+    Returns:
+        tuple[Path, Union[tuple[dict, dict], None], dict, Union[str, None]]:
+        file path, its fragment and full file scores, cache and time usage
+        of the file, and error message if the file could not be compared
+    """
+    try:
+        results = _worker_tester.compare_file(og_fpath)
+        error = None
+    except Exception as e:
+        results, error = None, f"{type(e).__name__}: {e}"
+    return og_fpath, results, _worker_tester.take_usage(), error
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Similarity testing of completions")
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_KINDS,
+        default=const.DEFAULT_COMPLETION_STORAGE,
+        help="format in which autocompletions were saved",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of comparing processes, 1 runs in the current process",
+    )
+    parser.add_argument(
+        "--max-distance",
+        type=int,
+        help="bounded mode: record Damerau-Levenshtein distances "
+        "from this value up as censored instead of computing them",
+    )
+    parser.add_argument(
+        "--min-ratio",
+        type=float,
+        help="bounded mode: record SequenceMatcher ratios whose quick upper bounds "
+        "fall below this value as censored instead of computing them",
+    )
+    parser.add_argument(
+        "--algorithms",
+        help="comma separated similarity algorithms to run, all by default: "
+        + ", ".join(SIMILARITY_ALGORITHMS),
+    )
+    parser.add_argument(
+        "--tokens",
+        action="store_true",
+        help="compare sequences of Python tokens instead of characters",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute all scores, bypassing the metric cache",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default=const.METRIC_CACHE_MAX_SIZE_MB,
+        help="size bound of the metric cache",
+    )
+    return parser.parse_args()
 
 
 def main():
-    fragment_out_dir_path = utils.get_data_dir() / "similarity_logs_fragment"
-    full_out_dir_path = utils.get_data_dir() / "similarity_logs_full"
-    tester = SimilarityTester(fragment_out_dir_path, full_out_dir_path)
+    args = parse_args()
+    results_store = open_results_store(SIMILARITY_RESULTS)
+    completion_store = open_completion_store(args.storage)
+    metric_cache = None if args.no_cache else open_metric_cache(args.cache_size_mb)
+    tester = SimilarityTester(
+        results_store,
+        completion_store,
+        metric_cache,
+        args.workers,
+        args.max_distance,
+        args.min_ratio,
+        args.tokens,
+        args.algorithms.split(",") if args.algorithms else None,
+    )
     tester.run()
+    results_store.close()
+    completion_store.close()
+    if metric_cache is not None:
+        metric_cache.close()
 
 
 if __name__ == "__main__":
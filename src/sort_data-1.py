@@ -1,31 +1,78 @@
+import os
+import json
+import errno
 import shutil
 import argparse
 
 from pathlib import Path
-from collections.abc import Generator
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import get_data_dir
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from utils import get_data_dir, write_to_file
+from manifest import ManifestEntry, aliases_path, load_manifest
+
+LINK_MODES = ("copy", "hardlink", "reflink")
+# ioctl cloning a whole file on copy-on-write filesystems, e.g. Btrfs or XFS
+FICLONE = 0x40049409
+
+
+def reflink(source: Path, destination: Path):
+    """Clone the file sharing its data blocks, keeping its metadata like copy2
+
+    Args:
+        source (Path): file's original location
+        destination (Path): destination for file's clone
+
+    Raises:
+        OSError: if the platform or the filesystem cannot clone files
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported", str(source))
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, destination)
 
 
 class DataSorter:
     """
     Utility for sorting raw dataset,
-    by keeping only the files with allowed extensions
-    and removing the ones that are empty
+    by keeping only the files with allowed extensions,
+    removing the ones that are empty and keeping a single copy
+    of files with identical content, the others are recorded as its aliases
     """
 
     def __init__(
-        self, in_dir_path: Path, out_dir_path: Path, file_extensions: list[str]
+        self,
+        in_dir_path: Path,
+        out_dir_path: Path,
+        file_extensions: Iterable[str],
+        link: str = "copy",
+        workers: int = None,
     ):
         """
         Args:
             in_dir_path (Path): path to raw/unsorted dataset
             out_dir_path (Path): destination path to save sorted copy of raw dataset
-            file_extensions (list[str]): allowed extensions of the files to keep
+            file_extensions (Iterable[str]): allowed extensions of the files to keep
+            link (str, optional): one of LINK_MODES, how files are placed
+            in the sorted dataset. Defaults to "copy".
+            workers (int, optional): threads stating, hashing and copying files.
+            Defaults to the default of ThreadPoolExecutor.
         """
+        if link not in LINK_MODES:
+            raise ValueError(f"Unknown link mode: {link}")
         self._in_dir_path = in_dir_path
         self._out_dir_path = out_dir_path
-        self._file_extensions = file_extensions
+        self._file_extensions = frozenset(file_extensions)
+        self._link = link
+        self._workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        self._aliases_path = aliases_path(out_dir_path)
 
     def _file_extension_allowed(self, fpath: Path) -> bool:
         """Check if extension of file is on allowed list
@@ -36,57 +83,174 @@ class DataSorter:
         Returns:
             bool: True for allowed extension, False otherwise
         """
-        file_extension_without_dot = fpath.suffix[1:]
-        return any([file_extension_without_dot == ext for ext in self._file_extensions])
+        return fpath.suffix[1:] in self._file_extensions
 
-    def _file_not_empty(self, fpath: Path) -> bool:
-        """Checks if file's contents are not empty
+    def _deduplicate(
+        self, entries: Iterable[ManifestEntry]
+    ) -> tuple[list[ManifestEntry], dict[str, str]]:
+        """Drop empty files and keep the first of the files sharing content
 
         Args:
-            fpath (Path): filepath to check
+            entries (Iterable[ManifestEntry]): raw files in manifest order
 
         Returns:
-            bool: True for file not empty, False otherwise
+            tuple[list[ManifestEntry], dict[str, str]]: files to place
+            in the sorted dataset and the kept file of every duplicate
         """
-        return fpath.stat().st_size != 0
+        kept, aliases = {}, {}
+        for entry in entries:
+            if entry.size == 0:
+                continue
+            if entry.sha256 in kept:
+                aliases[entry.relative_path] = kept[entry.sha256].relative_path
+            else:
+                kept[entry.sha256] = entry
+        return list(kept.values()), aliases
 
-    def _next_matching_filepath(self) -> Generator[Path]:
-        """Iterates over and yields files from the raw dataset
-         that fit the sorting criteria
+    def _up_to_date(self, entry: ManifestEntry, destination: Path) -> bool:
+        """
+        Args:
+            entry (ManifestEntry): raw file
+            destination (Path): its location in the sorted dataset
 
-        Yields:
-            Generator[Path]: matching filepath
+        Returns:
+            bool: True if an earlier run already placed the same file
         """
-        for f in self._in_dir_path.rglob("*"):
-            if (
-                f.is_file()
-                and self._file_extension_allowed(f)
-                and self._file_not_empty(f)
-            ):
-                yield f
+        try:
+            stat = destination.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        source = self._in_dir_path / entry.relative_path
+        linked = os.path.samefile(source, destination)
+        if self._link == "hardlink":
+            return linked
+        return (
+            not linked
+            and stat.st_size == entry.size
+            and stat.st_mtime_ns == entry.mtime_ns
+        )
 
-    def _copy_file_from_to(self, source: Path, destination: Path):
-        """Copy file from source to destination
+    def _place_file(self, entry: ManifestEntry) -> str:
+        """Copy or link file from source to destination,
+        unless it is already there
 
         Args:
-            source (Path): file's original location
-            destination (Path): destination for file's copy
+            entry (ManifestEntry): raw file
+
+        Returns:
+            str: "placed", "copied" in place of an unsupported reflink,
+            or "up to date"
         """
+        source = self._in_dir_path / entry.relative_path
+        destination = self._out_dir_path / entry.relative_path
+        if self._up_to_date(entry, destination):
+            return "up to date"
         destination.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(source, destination, follow_symlinks=False)
+        destination.unlink(missing_ok=True)
+        if self._link == "hardlink":
+            os.link(source, destination)
+        elif self._link == "reflink":
+            try:
+                reflink(source, destination)
+            except OSError as e:
+                if e.errno not in (
+                    errno.EOPNOTSUPP,
+                    errno.ENOTTY,
+                    errno.EXDEV,
+                    errno.EINVAL,
+                ):
+                    raise
+                # filesystem without copy-on-write, a full copy instead
+                shutil.copy2(source, destination)
+                return "copied"
+        else:
+            shutil.copy2(source, destination, follow_symlinks=False)
+        return "placed"
+
+    def _prune(self, kept: set[str]):
+        """Remove files of earlier runs that are no longer kept,
+        e.g. deleted from the raw dataset or found to be duplicates
+
+        Args:
+            kept (set[str]): relative paths of the sorted dataset
+        """
+        for root, dirs, files in os.walk(self._out_dir_path, topdown=False):
+            root_path = Path(root)
+            for name in files:
+                fpath = root_path / name
+                if fpath.relative_to(self._out_dir_path).as_posix() not in kept:
+                    fpath.unlink()
+            if root_path != self._out_dir_path and not any(root_path.iterdir()):
+                root_path.rmdir()
+
+    def plan(self, persist: bool = True) -> tuple[list[ManifestEntry], dict[str, str]]:
+        """Scan the raw database without touching the sorted one
+
+        Args:
+            persist (bool, optional): update the manifest of the raw database,
+            False leaves the disk untouched. Defaults to True.
+
+        Returns:
+            tuple[list[ManifestEntry], dict[str, str]]: files the sorted database
+            consists of and the kept file of every duplicate
+        """
+        raw_manifest = load_manifest(
+            self._in_dir_path, self._file_extension_allowed, self._workers, persist
+        )
+        return self._deduplicate(raw_manifest)
 
     def run(self):
-        """Perform sorting by copying for the whole raw database"""
-        for fpath in self._next_matching_filepath():
-            self._copy_file_from_to(
-                fpath, self._out_dir_path / fpath.relative_to(self._in_dir_path)
-            )
+        """Perform sorting by copying or linking the files of the raw database
+        in parallel, skipping the ones placed by earlier runs,
+        and record the manifest of the sorted database for the later stages"""
+        entries, aliases = self.plan()
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            outcomes = Counter(executor.map(self._place_file, entries))
+        self._prune({entry.relative_path for entry in entries})
+        write_to_file(self._aliases_path, json.dumps(aliases, indent=1))
+        if outcomes["copied"]:
+            print(f"Reflinks unsupported, copied {outcomes['copied']} files instead")
+        print(
+            f"Sorted {len(entries)} files, "
+            f"{outcomes['placed'] + outcomes['copied']} placed, "
+            f"{len(aliases)} duplicates recorded in {self._aliases_path}"
+        )
+        load_manifest(self._out_dir_path, workers=self._workers)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Sort the raw dataset")
+    parser.add_argument(
+        "--extensions",
+        default="py",
+        help="comma separated file extensions to keep",
+    )
+    parser.add_argument(
+        "--link",
+        choices=LINK_MODES,
+        default="copy",
+        help="place files as copies, hardlinks sharing the raw files "
+        "(edits show up in both) or copy-on-write reflinks",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of threads stating, hashing and copying files",
+    )
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
     raw_db_path: Path = get_data_dir() / "raw"
     sorted_db_path: Path = get_data_dir() / "sorted"
-    sorter = DataSorter(raw_db_path, sorted_db_path, ["py"])
+    sorter = DataSorter(
+        raw_db_path,
+        sorted_db_path,
+        args.extensions.split(","),
+        args.link,
+        args.workers,
+    )
     sorter.run()
 
 
@@ -0,0 +1,211 @@
+import re
+import ast
+import hashlib
+
+from typing import Union
+from collections import OrderedDict
+from dataclasses import dataclass, astuple
+
+from radon.complexity import cc_visit_ast
+from radon.metrics import h_visit_ast, halstead_visitor_report
+from radon.visitors import HalsteadVisitor
+
+BLOCK_CACHE_SIZE = 8192
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+_OPAQUE = object()
+
+
+@dataclass
+class StaticMetrics:
+    """Static metric scores of a single program,
+    all None when the program could not be parsed"""
+
+    cyclomatic_complexity: Union[float, None]
+    halstead_effort: Union[float, None]
+    halstead_bugs: Union[float, None]
+    parseable: bool = True
+
+    def as_row(self) -> list[Union[float, None]]:
+        """
+        Returns:
+            list[Union[float, None]]: scores ordered as const.METRICS
+        """
+        return list(astuple(self)[:3])
+
+
+UNPARSEABLE = StaticMetrics(None, None, None, parseable=False)
+
+
+@dataclass(frozen=True)
+class BlockMetrics:
+    """Partial results of a single top-level statement,
+    e.g. a function or a class, which add up to the file-level scores"""
+
+    complexities: tuple[int, ...]
+    operators: int
+    operands: int
+    operators_seen: frozenset
+    operands_seen: frozenset
+    # operands radon identifies by their AST node, distinct from all others
+    opaque_operands: int
+
+
+def average_complexity(tree: ast.Module) -> Union[float, None]:
+    """Average cyclomatic complexity of all blocks, same as `radon cc --total-average`
+
+    Args:
+        tree (ast.Module): parsed program
+
+    Returns:
+        Union[float, None]: average over functions, methods and classes,
+        or None if the program has none of them
+    """
+    blocks = cc_visit_ast(tree)
+    if not blocks:
+        return None
+    return sum(block.complexity for block in blocks) / len(blocks)
+
+
+def block_metrics(statement: ast.stmt) -> BlockMetrics:
+    """
+    Args:
+        statement (ast.stmt): top-level statement of a module
+
+    Returns:
+        BlockMetrics: complexity of every block defined in the statement
+        and its Halstead operators and operands
+    """
+    complexities = tuple(
+        block.complexity
+        for block in cc_visit_ast(ast.Module(body=[statement], type_ignores=[]))
+    )
+    visitor = HalsteadVisitor.from_ast(statement)
+    operands_seen = frozenset(
+        operand
+        for operand in visitor.operands_seen
+        if not isinstance(operand[1], ast.AST)
+    )
+    return BlockMetrics(
+        complexities,
+        visitor.operators,
+        visitor.operands,
+        frozenset(visitor.operators_seen),
+        operands_seen,
+        len(visitor.operands_seen) - len(operands_seen),
+    )
+
+
+class StaticMetricsEngine:
+    """
+    Computes static metrics per top-level statement and caches them
+    by the statement's source text, so the blocks a completion shares
+    with its original, or with completions at other prefix ratios,
+    are analyzed once; file-level scores are rebuilt from the blocks
+    """
+
+    def __init__(self, cache_size: int = BLOCK_CACHE_SIZE):
+        """
+        Args:
+            cache_size (int, optional): number of blocks kept in memory.
+            Defaults to BLOCK_CACHE_SIZE.
+        """
+        self._cache_size = cache_size
+        self._blocks: OrderedDict[str, BlockMetrics] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def compute(self, content: str) -> StaticMetrics:
+        """Parse the program once and score it from its cached or analyzed blocks
+
+        Args:
+            content (str): program source code
+
+        Returns:
+            StaticMetrics: scores of the program, UNPARSEABLE for broken code
+        """
+        try:
+            tree = ast.parse(content)
+            lines = _LINE_BREAK.split(content)
+            return self._merge(
+                [self._block(statement, lines) for statement in tree.body]
+            )
+        except (SyntaxError, ValueError, RecursionError):
+            return UNPARSEABLE
+
+    def _block(self, statement: ast.stmt, lines: list[str]) -> BlockMetrics:
+        first_lineno = min(
+            [statement.lineno]
+            + [
+                decorator.lineno
+                for decorator in getattr(statement, "decorator_list", [])
+            ]
+        )
+        source = "\n".join(lines[first_lineno - 1 : statement.end_lineno])
+        # statements sharing a line, e.g. `a = 1; b = 2`, differ by their columns
+        key = hashlib.sha256(
+            f"{statement.col_offset}:{statement.end_col_offset}:{source}".encode(
+                "utf-8", "surrogatepass"
+            )
+        ).hexdigest()
+        block = self._blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return block
+        self.misses += 1
+        block = block_metrics(statement)
+        self._blocks[key] = block
+        if len(self._blocks) > self._cache_size:
+            self._blocks.popitem(last=False)
+        return block
+
+    @staticmethod
+    def _merge(blocks: list[BlockMetrics]) -> StaticMetrics:
+        complexities = [c for block in blocks for c in block.complexities]
+        visitor = HalsteadVisitor()
+        for block in blocks:
+            visitor.operators += block.operators
+            visitor.operands += block.operands
+            visitor.operators_seen.update(block.operators_seen)
+            visitor.operands_seen.update(block.operands_seen)
+        opaque_operands = sum(block.opaque_operands for block in blocks)
+        visitor.operands_seen.update((_OPAQUE, i) for i in range(opaque_operands))
+        halstead = halstead_visitor_report(visitor)
+        return StaticMetrics(
+            sum(complexities) / len(complexities) if complexities else None,
+            halstead.effort,
+            halstead.bugs,
+        )
+
+
+_default_engine = StaticMetricsEngine()
+
+
+def compute_static_metrics(content: str) -> StaticMetrics:
+    """Score the program, reusing block results from earlier calls
+    in this process, e.g. for the original of a completion
+
+    Args:
+        content (str): program source code
+
+    Returns:
+        StaticMetrics: scores of the program, UNPARSEABLE for broken code
+    """
+    return _default_engine.compute(content)
+
+
+def compute_static_metrics_uncached(content: str) -> StaticMetrics:
+    """Parse the program once and compute all static metrics from the whole tree
+
+    Args:
+        content (str): program source code
+
+    Returns:
+        StaticMetrics: scores of the program, UNPARSEABLE for broken code
+    """
+    try:
+        tree = ast.parse(content)
+        halstead = h_visit_ast(tree).total
+        return StaticMetrics(average_complexity(tree), halstead.effort, halstead.bugs)
+    except (SyntaxError, ValueError, RecursionError):
+        return UNPARSEABLE
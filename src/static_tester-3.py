@@ -1,22 +1,31 @@
 import os
-import subprocess
-import io
-import re
+import argparse
 
-from collections.abc import Generator
-from typing import Union
 from tqdm import tqdm
 from pathlib import Path
-
-
-from utils import get_data_dir
+from typing import Union
+from collections.abc import Iterable, Sized
+
+from utils import get_data_dir, load_file, parallel_map
+from manifest import load_manifest
+from completion_store import (
+    CompletionStore,
+    FileCompletionStore,
+    STORAGE_KINDS,
+    open_completion_store,
+)
+from static_metrics import StaticMetrics, compute_static_metrics
+from metric_cache import MetricCache, open_metric_cache
+from running_stats import STATIC_SUMMARY, ResultsSummary
+from results_store import (
+    ORIGINAL_PREFIX_RATIO,
+    STATIC_RESULTS,
+    STATIC_SCOPE,
+    ResultsStore,
+    open_results_store,
+)
 import const
 
-import warnings
-
-warnings.filterwarnings(action="ignore", category=FutureWarning)
-import pandas as pd
-
 
 class StaticTester:
     """Utility to test Tabby generated code using static evaluation metrics:
@@ -25,192 +34,225 @@ class StaticTester:
     - halstead bugs
     """
 
-    def __init__(self, out_dir_path: Path):
+    def __init__(
+        self,
+        results_store: ResultsStore,
+        completion_store: CompletionStore,
+        workers: int = 1,
+        metric_cache: MetricCache = None,
+    ):
         """
         Args:
-            out_dir_path (Path): path to save the testing scores
-        """
-        self._out_dir_path = out_dir_path
-        self._complexity_command = [
-            "radon",
-            "cc",
-            "--total-average",
-            "-s",
-        ]
-        self._halstead_command = [
-            "radon",
-            "hal",
-        ]
-        self._reset_dataframe()
-
-    def _reset_dataframe(self):
-        """
-        Clears the dataframe, keeping the column indexes
-        """
-        self._results_df = None
-        cols = const.METRICS
-        self._results_df = pd.DataFrame(columns=cols)
-
-    def _next_reference_filepath(self):
+            results_store (ResultsStore): consolidated store of the testing scores
+            completion_store (CompletionStore): source of Tabby autocompletions
+            workers (int, optional): number of processes evaluating files,
+            each file with all its completions is a single work unit. Defaults to 1.
+            metric_cache (MetricCache, optional): scores of programs
+            evaluated in earlier runs. Defaults to None.
         """
-        Yields:
-            Generator[Path]: paths to files in the input directory
-        """
-        sorted_dir = get_data_dir() / "sorted"
-        for fpath in sorted_dir.rglob("*"):
-            if fpath.is_file():
-                yield fpath
+        self._results_store = results_store
+        self._completion_store = completion_store
+        self._workers = workers
+        self._metric_cache = metric_cache
+        self._sorted_dir_path = get_data_dir() / "sorted"
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        # results are written by the main process only
+        state["_results_store"] = None
+        return state
+
+    def run(self, paths: Iterable[Path] = None) -> list[Path]:
+        """Run static evaluation testing cycle on all files,
+        results are written by this process only, in manifest order
 
-    def _next_completed_by_prefix(self, og_fpath: Path) -> Generator[tuple[int, Path]]:
-        """
-        Iterates through prefix-ratio directories in autocompleted directory,
-        in each searching for the corresponding reference file path.
         Args:
-            og_fpath (Path): reference file path
+            paths (Iterable[Path], optional): reference files to evaluate again,
+            keeping the stored results of all others, possibly streamed
+            while their completions are fetched. Defaults to all files.
 
-        Yields:
-            Generator[tuple[int, Path]]: prefix_ratio of the prompt
-            and path to file generated with this prompt
+        Returns:
+            list[Path]: reference files that could not be evaluated
         """
-        autocompletions_dir = get_data_dir() / "autocompletions"
-        og_relative_path = og_fpath.relative_to(get_data_dir() / "sorted")
-        for dir_ in autocompletions_dir.iterdir():
-            prefix_ratio = dir_.name.split("-")[-1]
-            for fpath in dir_.rglob("*"):
-                if fpath.is_file():
-                    relative_path = fpath.relative_to(dir_)
-                    if relative_path == og_relative_path:
-                        yield int(prefix_ratio), fpath
-
-    def _get_cc_complexity(self, cc_output: str) -> Union[float, None]:
-        """Get complexity value from Radon's output
+        if paths is None:
+            paths = list(load_manifest(self._sorted_dir_path).paths())
+            summary = ResultsSummary()
+            # duplicates left out by the sorting count with the file kept
+            duplicates = self._results_store.duplicates()
+        else:
+            # aggregates are rebuilt from the store, covering the files kept
+            summary = None
+        if isinstance(self._completion_store, FileCompletionStore):
+            if isinstance(paths, Sized):
+                # walk the autocompletions once here instead of once per worker
+                self._completion_store.build_index()
+            else:
+                # streamed files are looked up as their completions arrive
+                self._completion_store.clear_index()
+        unparseable_count, failed = 0, []
+        cache_hits, cache_misses = 0, 0
+        results = parallel_map(
+            _evaluate_in_worker,
+            paths,
+            self._workers,
+            initializer=_init_worker,
+            initargs=(self,),
+        )
+        progress = tqdm(
+            results,
+            desc="Static evaluation",
+            total=len(paths) if isinstance(paths, Sized) else None,
+        )
+        for fpath, results, unparseable, (hits, misses), error in progress:
+            cache_hits += hits
+            cache_misses += misses
+            if error is not None:
+                failed.append(fpath)
+                tqdm.write(f"{fpath.relative_to(self._sorted_dir_path)}: {error}")
+                continue
+            unparseable_count += unparseable
+            relative_path = fpath.relative_to(self._sorted_dir_path)
+            self._results_store.add(STATIC_SCOPE, relative_path, results)
+            if summary is not None:
+                summary.add(
+                    STATIC_SCOPE,
+                    results,
+                    1 + len(duplicates.get(relative_path.as_posix(), [])),
+                )
+        self._results_store.flush()
+        if summary is None:
+            summary = ResultsSummary.from_store(self._results_store, [STATIC_SCOPE])
+        summary.save(get_data_dir() / STATIC_SUMMARY)
+        tqdm.write(
+            f"Static evaluation done, {unparseable_count} programs unparseable, "
+            f"{len(failed)} files failed"
+        )
+        if self._metric_cache is not None:
+            lookups = cache_hits + cache_misses
+            tqdm.write(
+                f"Metric cache: {cache_hits} hits, {cache_misses} misses, "
+                f"hit rate {cache_hits / lookups if lookups else 0.0:.4f}"
+            )
+        return failed
+
+    def evaluate_file(
+        self, fpath: Path
+    ) -> tuple[dict[int, dict[str, Union[float, None]]], int]:
+        """Score the reference file and all of its autocompletions
 
         Args:
-            cc_output (str): Radon's command output for cyclomatic complexity
+            fpath (Path): reference file path
 
         Returns:
-            Union[float, None]: complexity value,
-            or None if no matches found
+            tuple[dict[int, dict[str, Union[float, None]]], int]: scores by prefix
+            ratio, ORIGINAL_PREFIX_RATIO for the reference file,
+            and number of unparseable programs
         """
-        pattern = r"Average complexity:\s*(\w) \(([\d.]+)\)"
-        match = re.search(pattern, cc_output)
-        if match:
-            return float(match.group(2))
-        else:
-            return None
-
-    def _get_halstead_effort_bugs(
-        self, halstead_output: str
-    ) -> Union[tuple[float, float], None]:
-        """Get Halsted bugs and effort values from Radon's output
+        og_content = load_file(fpath)
+        metrics = self._evaluate(og_content)
+        unparseable = int(not metrics.parseable)
+        results = {ORIGINAL_PREFIX_RATIO: dict(zip(const.METRICS, metrics.as_row()))}
+        for prefix_ratio, completion in self._completion_store.next_completion(
+            fpath.relative_to(self._sorted_dir_path), og_content
+        ):
+            metrics = self._evaluate(completion)
+            unparseable += int(not metrics.parseable)
+            results[prefix_ratio] = dict(zip(const.METRICS, metrics.as_row()))
+        return results, unparseable
 
+    def _evaluate(self, content: str) -> StaticMetrics:
+        """
         Args:
-            halstead_output (str): Radon's command output for Halstead metrics
+            content (str): program for which to run the evaluation
 
         Returns:
-            Union[tuple[float, float], None]: tuple of (effort, bugs),
-            or None if no matches found
+            StaticMetrics: metric scores, from the metric cache if available
         """
-        pattern = r"effort:\s*([\d.]+).*?bugs:\s*([\d.]+)"
-        match = re.search(pattern, halstead_output, re.DOTALL)
-
-        if match:
-            effort = float(match.group(1))
-            bugs = float(match.group(2))
-            return effort, bugs
-        else:
-            return None, None
+        if self._metric_cache is None:
+            return compute_static_metrics(content)
+        return self._metric_cache.static_metrics(content, compute_static_metrics)
 
-    def _total_file_count(self) -> int:
+    def cache_counters(self) -> tuple[int, int]:
         """
         Returns:
-            int: total number of files in input directory
-        """
-        sorted_dir = get_data_dir() / "sorted"
-        total = 0
-        for root, dirs, files in os.walk(sorted_dir):
-            total += len(files)
-        return total
-
-    def run(self):
-        """Run static evaluation testing cycle on all files"""
-        for fpath in tqdm(
-            self._next_reference_filepath(),
-            desc="Static evaluation",
-            total=self._total_file_count(),
-            leave=False,
-        ):
-            og_cc_complexity, og_hal_effort, og_hal_bugs = self._run_subprocesses(fpath)
-            self._results_df.loc["original"] = [
-                og_cc_complexity,
-                og_hal_effort,
-                og_hal_bugs,
-            ]
-            for prefix_ratio, completion_path in tqdm(
-                self._next_completed_by_prefix(fpath),
-                desc=f"{fpath.parent.name}/{fpath.name}",
-                total=9,
-                leave=False,
-            ):
-                cc_complexity, hal_effort, hal_bugs = self._run_subprocesses(
-                    completion_path
-                )
-                self._results_df.loc[str(prefix_ratio)] = [
-                    cc_complexity,
-                    hal_effort,
-                    hal_bugs,
-                ]
-            self._save_results(fpath)
-            self._reset_dataframe()
-
-    def _save_results(self, og_fpath: Path):
-        """
-        Creates path to save testing results, by recreating
-         the relative structure of reference file from the source directory.
-        Args:
-            og_fpath (Path): reference file path
+            tuple[int, int]: metric cache hits and misses in this process
         """
-        dest_fpath = (
-            self._out_dir_path
-            / og_fpath.relative_to(get_data_dir() / "sorted").parent
-            / f"{og_fpath.name.split('.')[0]}.csv"
-        )
-        dest_fpath.parent.mkdir(parents=True, exist_ok=True)
-        self._results_df.to_csv(dest_fpath, float_format="%.4f")
+        if self._metric_cache is None:
+            return 0, 0
+        return self._metric_cache.hits, self._metric_cache.misses
 
-    def _run_subprocesses(self, fpath: Path) -> Union[tuple[float, float, float], None]:
-        """
 
-        Args:
-            fpath (Path): path for which to run the evaluation
+_worker_tester: StaticTester = None
 
-        Returns:
-            Union[tuple[float, float, float], None]: Metric score values,
-            extracted from Radon's commands outputs
-        """
-        hal_effort, hal_bugs, cc_complexity = None, None, None
 
-        cc_process = subprocess.run(
-            args=[*self._complexity_command, fpath], capture_output=True, text=True
-        )
-        if cc_process.returncode == 0:
-            cc_output = cc_process.stdout
-            cc_complexity = self._get_cc_complexity(cc_output)
+def _init_worker(tester: StaticTester):
+    global _worker_tester
+    _worker_tester = tester
 
-        hal_process = subprocess.run(
-            args=[*self._halstead_command, fpath], capture_output=True, text=True
-        )
-        if hal_process.returncode == 0:
-            hal_output = hal_process.stdout
-            hal_effort, hal_bugs = self._get_halstead_effort_bugs(hal_output)
 
-        return cc_complexity, hal_effort, hal_bugs
+def _evaluate_in_worker(
+    fpath: Path,
+) -> tuple[Path, Union[dict, None], int, tuple[int, int], Union[str, None]]:
+    """
+    Args:
+        fpath (Path): reference file path
+
+    Returns:
+        tuple[Path, Union[dict, None], int, tuple[int, int], Union[str, None]]:
+        file path, its scores by prefix ratio, unparseable program count,
+        metric cache hits and misses, and error message
+        if the file could not be evaluated
+    """
+    hits, misses = _worker_tester.cache_counters()
+    try:
+        results, unparseable = _worker_tester.evaluate_file(fpath)
+        error = None
+    except Exception as e:
+        results, unparseable, error = None, 0, f"{type(e).__name__}: {e}"
+    new_hits, new_misses = _worker_tester.cache_counters()
+    cache_counts = (new_hits - hits, new_misses - misses)
+    return fpath, results, unparseable, cache_counts, error
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Static evaluation of completions")
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_KINDS,
+        default=const.DEFAULT_COMPLETION_STORAGE,
+        help="format in which autocompletions were saved",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of evaluating processes, 1 runs in the current process",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute all scores, bypassing the metric cache",
+    )
+    parser.add_argument(
+        "--cache-size-mb",
+        type=int,
+        default=const.METRIC_CACHE_MAX_SIZE_MB,
+        help="size bound of the metric cache",
+    )
+    return parser.parse_args()
 
 
 def main():
-    out_dir_path = get_data_dir() / "static_metrics"
-    tester = StaticTester(out_dir_path)
+    args = parse_args()
+    results_store = open_results_store(STATIC_RESULTS)
+    completion_store = open_completion_store(args.storage)
+    metric_cache = None if args.no_cache else open_metric_cache(args.cache_size_mb)
+    tester = StaticTester(results_store, completion_store, args.workers, metric_cache)
     tester.run()
+    results_store.close()
+    completion_store.close()
+    if metric_cache is not None:
+        metric_cache.close()
 
 
 if __name__ == "__main__":
@@ -1,42 +1,106 @@
 import requests
 import json
 import os
+import time
 
 from pprint import pprint
+from typing import Union
+from urllib.parse import urljoin
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from completion_cache import CompletionCache
+from endpoint_pool import EndpointPool
+from request_log import RequestRecord
+
 
 class TabbyConnection:
     """
     Connection to tabby server utilities
     """
 
-    def __init__(self, url: str, auth_token: str):
+    def __init__(
+        self,
+        url: Union[str, list[str], EndpointPool],
+        auth_token: str,
+        cache: Union[CompletionCache, None] = None,
+        stream: bool = False,
+    ):
         """
         Args:
-            url (str): api url for fetching suggestions
+            url (Union[str, list[str], EndpointPool]): api url for fetching suggestions,
+            or urls of several replicas to balance the requests across
             auth_token (str): authorization token for Tabby services
+            cache (Union[CompletionCache, None], optional): persistent cache
+            answering repeated requests. Defaults to None.
+            stream (bool, optional): ask for server-sent events and read
+            the completion incrementally. Defaults to False.
         """
-        self._url = url
+        if isinstance(url, str):
+            url = [url]
+        if not isinstance(url, EndpointPool):
+            url = EndpointPool(url)
+        self._endpoint_pool = url
         self._auth_token = auth_token
+        self._cache = cache
+        self._stream = stream
         self._session = requests.Session()
         self._session.headers = {
             "Content-Type": "application/json",
-            "Accept": "application/json",
+            "Accept": (
+                "text/event-stream, application/json" if stream else "application/json"
+            ),
             "Authorization": f"access_token {auth_token}",
         }
         self._adapt_session()
 
+    def clone(self) -> "TabbyConnection":
+        """Create a connection to the same endpoint with its own session,
+        for use from another thread
+
+        Returns:
+            TabbyConnection: connection sharing endpoints, credentials and cache
+        """
+        return TabbyConnection(
+            self._endpoint_pool, self._auth_token, self._cache, self._stream
+        )
+
+    @property
+    def cache(self) -> Union[CompletionCache, None]:
+        return self._cache
+
+    @property
+    def endpoint_pool(self) -> EndpointPool:
+        return self._endpoint_pool
+
+    def server_tag(self) -> str:
+        """Identify the server and the model behind it using the health endpoint
+
+        Returns:
+            str: model name and server version of the first replica,
+            or its url if the server does not report them
+        """
+        url = self._endpoint_pool.urls[0]
+        try:
+            response = self._session.get(urljoin(url, "/v1/health"), timeout=(10, 30))
+            response.raise_for_status()
+            health = response.json()
+        except (requests.RequestException, ValueError):
+            return url
+        version = health.get("version", {}).get("git_describe", "unknown")
+        return f"{health.get('model', 'unknown')}@{version}"
+
     def _adapt_session(self):
         """
-        Apply wind-down & retry strategy to HTTP requests
-        encountering server-side issues
+        Apply retry strategy to HTTP requests failing to connect,
+        server-side issues are left to the caller's rate control
         """
         retry_strategy = Retry(
-            total=10,
-            backoff_factor=2,
-            status_forcelist=[408, 500, 502, 503, 504],
+            total=3,
+            connect=3,
+            read=0,
+            status=0,
+            backoff_factor=0.5,
         )
         adapter = HTTPAdapter(max_retries=retry_strategy)
         self._session.mount("http://", adapter)
@@ -68,31 +132,131 @@ class TabbyConnection:
 
         return json.dumps(request_body)
 
-    def _send_post(self, post_data: str) -> dict:
-        """Send prepared body to Tabby autocompletion endpoint
+    def _send_post(
+        self,
+        post_data: str,
+        timeout: tuple[float, float],
+        record: Union[RequestRecord, None] = None,
+    ) -> dict:
+        """Send prepared body to the autocompletion endpoint
+        of the replica chosen by the endpoint pool
 
         Args:
             post_data (str): json request body serialized to string
+            timeout (tuple[float, float]): connect and read timeouts in seconds
+            record (Union[RequestRecord, None], optional): measurements
+            to fill with status and latencies of the response. Defaults to None.
 
         Returns:
             dict: response content turned to object
         """
-        response = self._session.post(url=self._url, data=post_data, timeout=(60, 120))
+        if self._stream:
+            post_data = json.dumps({**json.loads(post_data), "stream": True})
+        endpoint = self._endpoint_pool.acquire()
+        start = time.perf_counter()
+        response, response_data = None, None
+        try:
+            response = self._session.post(
+                url=endpoint.url, data=post_data, timeout=timeout, stream=self._stream
+            )
+            if response.ok:
+                response_data = self._read_response(response, start, record)
+        finally:
+            latency = time.perf_counter() - start
+            if response is not None and self._stream:
+                response.close()
+            self._endpoint_pool.release(
+                endpoint,
+                latency,
+                response is not None
+                and response.status_code != 429
+                and response.status_code < 500,
+            )
+        if record is not None:
+            record.server_latency = latency
+            record.status = response.status_code
+            record.endpoint = endpoint.url
         response.raise_for_status()
-        response_data = response.json()
         return response_data
 
-    def get_suggestion(self, language: str, prefix: str, suffix: str = None) -> dict:
+    def _read_response(
+        self,
+        response: requests.Response,
+        start: float,
+        record: Union[RequestRecord, None],
+    ) -> dict:
+        """Read body of a successful response, incrementally when streaming,
+        noting when the first byte and the first completion text arrived
+
+        Args:
+            response (requests.Response): response with unread body
+            start (float): performance counter value when the request was sent
+            record (Union[RequestRecord, None]): measurements to fill
+
+        Returns:
+            dict: response content turned to object,
+            with streamed text deltas assembled into a single choice
+        """
+        if not self._stream:
+            return response.json()
+
+        first_byte, first_token = None, None
+        if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+            body = b""
+            for chunk in response.iter_content(chunk_size=None):
+                first_byte = first_byte or time.perf_counter()
+                body += chunk
+            response_data = json.loads(body)
+            first_token = time.perf_counter()
+        else:
+            response_data, texts = {}, []
+            for line in response.iter_lines(decode_unicode=True):
+                first_byte = first_byte or time.perf_counter()
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                text = event.get("choices", [{}])[0].get("text", "")
+                if text and first_token is None:
+                    first_token = time.perf_counter()
+                texts.append(text)
+                response_data = event
+            response_data["choices"] = [{"index": 0, "text": "".join(texts)}]
+
+        if record is not None:
+            record.first_byte_latency = first_byte and first_byte - start
+            record.first_token_latency = first_token and first_token - start
+        return response_data
+
+    def get_suggestion(
+        self,
+        language: str,
+        prefix: str,
+        suffix: str = None,
+        timeout: tuple[float, float] = (60, 120),
+        record: Union[RequestRecord, None] = None,
+    ) -> dict:
         """Prepare request and retrieve response from the server
 
         Args:
             language (str): name of prefix&sufix's programming langauge
             prefix (str): _description_
             suffix (str, optional): _description_. Defaults to None.
+            timeout (tuple[float, float], optional): connect and read timeouts
+            in seconds. Defaults to (60, 120).
+            record (Union[RequestRecord, None], optional): measurements
+            to fill with status and latency of the response,
+            left untouched when the response comes from the cache. Defaults to None.
 
         Returns:
             dict: _description_
         """
         post_data = self._prepare_request_data(language, prefix, suffix)
-        response_data = self._send_post(post_data)
+        if self._cache is not None:
+            return self._cache.get_or_fetch(
+                post_data, lambda: self._send_post(post_data, timeout, record)
+            )
+        response_data = self._send_post(post_data, timeout, record)
         return response_data
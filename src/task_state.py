@@ -0,0 +1,158 @@
+import sqlite3
+import hashlib
+
+from pathlib import Path
+from typing import Union
+
+
+def combined_hash(*parts: str) -> str:
+    """
+    Args:
+        *parts (str): hashes, versions and settings a task depends on
+
+    Returns:
+        str: hex digest identifying all of the parts together
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def sources_hash(paths: list[Path]) -> str:
+    """
+    Args:
+        paths (list[Path]): source files of a pipeline stage
+
+    Returns:
+        str: hex digest of their contents, changing with the stage's code
+    """
+    return combined_hash(*(path.read_text() for path in paths))
+
+
+class TaskState:
+    """
+    Record of every completed pipeline task, a stage applied to a single file,
+    with the hash of its inputs at the time it ran and the hash of its output,
+    so a later run can tell which tasks are out of date
+    """
+
+    def __init__(self, db_path: Path, read_only: bool = False):
+        """
+        Args:
+            db_path (Path): location of the database
+            read_only (bool, optional): only inspect the recorded tasks,
+            creating or changing no files. Defaults to False.
+        """
+        if read_only and db_path.is_file():
+            self._connection = sqlite3.connect(
+                f"{db_path.resolve().as_uri()}?{self._read_only_query(db_path)}",
+                uri=True,
+                isolation_level=None,
+            )
+            return
+        if read_only:
+            # nothing recorded yet, nothing to create either
+            self._connection = sqlite3.connect(":memory:", isolation_level=None)
+        else:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(db_path, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "stage TEXT NOT NULL, file TEXT NOT NULL, "
+            "input_hash TEXT NOT NULL, output_hash TEXT, "
+            "PRIMARY KEY (stage, file))"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS settings ("
+            "name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+
+    @staticmethod
+    def _read_only_query(db_path: Path) -> str:
+        """
+        Args:
+            db_path (Path): location of the database
+
+        Returns:
+            str: URI parameters opening the database without writing,
+            as immutable unless a run left its write-ahead log behind,
+            which keeps SQLite from creating the -wal and -shm files
+        """
+        if db_path.with_name(f"{db_path.name}-wal").exists():
+            return "mode=ro"
+        return "mode=ro&immutable=1"
+
+    def get(self, stage: str, file: str) -> Union[tuple[str, str], None]:
+        """
+        Args:
+            stage (str): pipeline stage
+            file (str): reference file path relative to the sorted database
+
+        Returns:
+            Union[tuple[str, str], None]: input and output hash
+            of the last completed run of the task, None if it never completed
+        """
+        return self._connection.execute(
+            "SELECT input_hash, output_hash FROM tasks WHERE stage = ? AND file = ?",
+            (stage, file),
+        ).fetchone()
+
+    def is_current(self, stage: str, file: str, input_hash: str) -> bool:
+        """
+        Returns:
+            bool: True if the task already completed with the same inputs
+        """
+        recorded = self.get(stage, file)
+        return recorded is not None and recorded[0] == input_hash
+
+    def record(self, stage: str, file: str, input_hash: str, output_hash: str = None):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)",
+            (stage, file, input_hash, output_hash),
+        )
+
+    def forget(self, stage: str, file: str):
+        """Mark the task out of date, e.g. when its inputs are about to change"""
+        self._connection.execute(
+            "DELETE FROM tasks WHERE stage = ? AND file = ?", (stage, file)
+        )
+
+    def setting(self, name: str) -> Union[str, None]:
+        """
+        Args:
+            name (str): setting of the last run, e.g. the server identifier
+
+        Returns:
+            Union[str, None]: its recorded value, None if never recorded
+        """
+        try:
+            row = self._connection.execute(
+                "SELECT value FROM settings WHERE name = ?", (name,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # read-only database of a version recording no settings
+            return None
+        return row[0] if row is not None else None
+
+    def record_setting(self, name: str, value: str):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, value)
+        )
+
+    def files(self, stage: str) -> set[str]:
+        """
+        Returns:
+            set[str]: files with a completed task of the stage
+        """
+        return {
+            file
+            for (file,) in self._connection.execute(
+                "SELECT file FROM tasks WHERE stage = ?", (stage,)
+            )
+        }
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,121 @@
+import io
+import re
+import tokenize
+
+import numpy as np
+
+SKIPPED_TOKENS = {tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER}
+MARKER_TOKENS = {tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT}
+_FALLBACK_TOKEN = re.compile(r"\w+|\S")
+_SURROGATES_START, _SURROGATES_SIZE = 0xD800, 0x800
+MAX_TOKEN_IDS = 0x110000 - _SURROGATES_SIZE
+
+
+def split_tokens(text: str) -> tuple[list[str], list[int]]:
+    """Tokenize a program with Python's tokenize, dropping blank lines
+    and keeping newlines and indentation changes as marker tokens;
+    code that cannot be tokenized, e.g. a truncated string,
+    is split into words and symbols from the failing token on
+
+    Args:
+        text (str): program source code
+
+    Returns:
+        tuple[list[str], list[int]]: tokens and their offsets in the text
+    """
+    line_starts = [0]
+    lines = io.StringIO(text)
+
+    def readline() -> str:
+        line = lines.readline()
+        line_starts.append(line_starts[-1] + len(line))
+        return line
+
+    tokens, offsets, consumed = [], [], 0
+    try:
+        for token in tokenize.generate_tokens(readline):
+            if token.type in SKIPPED_TOKENS:
+                continue
+            offset = line_starts[token.start[0] - 1] + token.start[1]
+            tokens.append(
+                tokenize.tok_name[token.type]
+                if token.type in MARKER_TOKENS
+                else token.string
+            )
+            offsets.append(min(offset, len(text)))
+            consumed = max(consumed, line_starts[token.end[0] - 1] + token.end[1])
+    except (tokenize.TokenError, SyntaxError):
+        for match in _FALLBACK_TOKEN.finditer(text, consumed):
+            tokens.append(match.group())
+            offsets.append(match.start())
+    return tokens, offsets
+
+
+class TokenEncoder:
+    """
+    Interns tokens to integer ids, stored as strings with one character
+    per token, so any string similarity algorithm runs on token sequences
+    """
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._tokens: list[str] = []
+
+    def encode(self, text: str) -> tuple[str, np.ndarray]:
+        """
+        Args:
+            text (str): program source code
+
+        Returns:
+            tuple[str, np.ndarray]: one character per token
+            and offsets of the tokens in the text
+        """
+        tokens, offsets = split_tokens(text)
+        ids = np.fromiter(
+            (self._intern(token) for token in tokens),
+            dtype=np.uint32,
+            count=len(tokens),
+        )
+        # skip the surrogate range, which cannot be encoded
+        ids += (ids >= _SURROGATES_START) * np.uint32(_SURROGATES_SIZE)
+        return ids.tobytes().decode("utf-32-le"), np.array(offsets, dtype=np.int64)
+
+    def decode(self, encoded: str) -> list[str]:
+        """
+        Args:
+            encoded (str): token sequence returned by encode
+
+        Returns:
+            list[str]: the tokens, independent of the interning order
+        """
+        return [
+            self._tokens[
+                code_point - _SURROGATES_SIZE * (code_point >= _SURROGATES_START)
+            ]
+            for code_point in map(ord, encoded)
+        ]
+
+    def _intern(self, token: str) -> int:
+        token_id = self._ids.get(token)
+        if token_id is None:
+            if len(self._tokens) >= MAX_TOKEN_IDS:
+                raise OverflowError("Too many distinct tokens to encode")
+            token_id = self._ids[token] = len(self._tokens)
+            self._tokens.append(token)
+        return token_id
+
+
+def token_slice(encoded: str, offsets: np.ndarray, start: int, end: int = None) -> str:
+    """
+    Args:
+        encoded (str): token sequence returned by TokenEncoder.encode
+        offsets (np.ndarray): offsets of the tokens in the text
+        start (int): first text offset of the slice
+        end (int, optional): text offset past the slice. Defaults to None.
+
+    Returns:
+        str: tokens starting within the text slice
+    """
+    first = int(np.searchsorted(offsets, start))
+    last = len(encoded) if end is None else int(np.searchsorted(offsets, end))
+    return encoded[first:last]
@@ -1,4 +1,9 @@
+import hashlib
+
 from pathlib import Path
+from collections.abc import Callable, Iterable, Iterator
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 project_dir = Path(__file__).resolve().parents[1]
 
@@ -21,3 +26,57 @@ def write_to_file(path: Path, content: str):
     path.parent.mkdir(parents=True, exist_ok=True)
     with open(path, "w") as f:
         f.write(content)
+
+
+def content_hash(content: str) -> str:
+    """
+    Args:
+        content (str): program source code
+
+    Returns:
+        str: hex digest of the content
+    """
+    return hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def parallel_map(
+    fn: Callable,
+    items: Iterable,
+    workers: int,
+    initializer: Callable = None,
+    initargs: tuple = (),
+    prefetch: int = 4,
+) -> Iterator:
+    """Apply function to items in a pool of worker processes,
+    or in the current process for a single worker
+
+    Args:
+        fn (Callable): picklable function applied to every item
+        items (Iterable): work units, consumed lazily
+        workers (int): number of worker processes
+        initializer (Callable, optional): called once in every worker. Defaults to None.
+        initargs (tuple, optional): arguments of the initializer. Defaults to ().
+        prefetch (int, optional): work units submitted ahead per worker,
+        bounding the results held in memory. Defaults to 4.
+
+    Yields:
+        Iterator: results in the order of the items
+    """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, items)
+        return
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= workers * prefetch:
+                yield pending.popleft().result()
+            # items may arrive slowly, e.g. streamed, pass on what is ready
+            while pending and pending[0].done():
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()